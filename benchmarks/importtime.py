@@ -0,0 +1,76 @@
+"""Cold start benchmark of the `leanda` entry point.
+
+Runs every subcommand in a fresh interpreter with `python -X importtime`
+and reports median import and wall time and which heavy dependencies
+the subcommand loaded. Commands run in-process, LEANDA_NO_DAEMON is set
+so a running daemon does not serve them.
+
+    python benchmarks/importtime.py
+    python benchmarks/importtime.py -n 10 -c "pwd" -c "ls -s"
+"""
+import argparse
+import os
+import shlex
+import statistics
+import subprocess
+import sys
+import time
+
+COMMANDS = ['--help', 'whoami', 'pwd', 'ls', 'upload --help',
+            'download --help', 'livesync --help']
+HEAVY_MODULES = ['requests', 'requests_toolbelt', 'magic', 'tqdm',
+                 'colorama', 'watchdog', 'signalrcore', 'pkg_resources',
+                 'humanfriendly', 'dotenv']
+# the `leanda` console script
+ENTRY_POINT = 'from leanda.daemon import main; main()'
+
+
+def parse_importtime(stderr):
+    """Returns (total import time in ms, set of top-level packages)"""
+    total = 0
+    packages = set()
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        (_, cumulative, name) = line.split('|', 2)
+        packages.add(name.strip().split('.')[0])
+        if not name[1:].startswith(' '):
+            total += int(cumulative)
+    return total / 1000, packages
+
+
+def run(command, runs):
+    import_times = []
+    wall_times = []
+    packages = set()
+    for _ in range(runs):
+        started = time.perf_counter()
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', ENTRY_POINT,
+             *shlex.split(command)],
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True,
+            env={**os.environ, 'LEANDA_NO_DAEMON': '1'})
+        wall_times.append((time.perf_counter() - started) * 1000)
+        (import_time, packages) = parse_importtime(result.stderr)
+        import_times.append(import_time)
+    return (statistics.median(import_times), statistics.median(wall_times),
+            [x for x in HEAVY_MODULES if x in packages])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-c', '--command', action='append',
+                        help='Subcommand with arguments, may be repeated.')
+    parser.add_argument('-n', '--runs', type=int, default=5,
+                        help='Runs per subcommand (default 5).')
+    args = parser.parse_args()
+
+    print(f'{"command":<20} {"imports ms":>10} {"wall ms":>10}  heavy modules')
+    for command in args.command or COMMANDS:
+        (import_time, wall_time, heavy) = run(command, args.runs)
+        print(f'{command:<20} {import_time:>10.1f} {wall_time:>10.1f}  '
+              f'{", ".join(heavy) or "-"}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,632 @@
+import aiohttp
+import asyncio
+import io
+import json
+import logging
+import os
+import time
+
+from contextlib import asynccontextmanager
+from os import path
+from tqdm import tqdm
+
+from leanda import util
+from leanda.api import auth, blobs, http, nodes
+from leanda.api.blobs import DOWNLOADED, FAILED, SKIPPED, UPLOADED
+from leanda.cache import node_cache
+from leanda.config import config
+from leanda.session import session
+
+logger = logging.getLogger('aio')
+
+TRANSFER_ERRORS = (aiohttp.ClientPayloadError, aiohttp.ClientConnectionError,
+                   asyncio.TimeoutError)
+
+
+def run(coroutine):
+    """Runs a coroutine of the async engine to completion.
+    Ctrl-C cancels all of its tasks"""
+    return asyncio.run(coroutine)
+
+
+class ProgressReader(io.BufferedReader):
+    """File reader reporting the number of bytes read to the callback"""
+
+    def __init__(self, raw, callback):
+        super().__init__(raw)
+        self.callback = callback
+
+    def read(self, size=-1):
+        chunk = super().read(size)
+        self.callback(len(chunk))
+        return chunk
+
+
+class Client():
+    """Asyncio client of the Leanda API, an alternative engine to the
+    thread based `nodes`, `blobs` and `http` modules.
+
+    At most `concurrency` requests are in flight at once, a request
+    holds its slot until its response body is read. Request and response
+    bodies are streamed. Cancelling a task cancels its requests, a
+    cancelled download is resumed from its `.part` file next time.
+    Shares the node cache and the session with the thread based engine.
+    """
+
+    def __init__(self, concurrency=None):
+        self.concurrency = concurrency or config.async_concurrency
+        self.semaphore = None
+        self.refresh_lock = None
+        self.client_session = None
+
+    async def __aenter__(self):
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.refresh_lock = asyncio.Lock()
+        self.client_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.concurrency),
+            timeout=aiohttp.ClientTimeout(
+                total=None, sock_connect=30, sock_read=300))
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.client_session.close()
+
+    async def get_token(self):
+        """Returns the access token, refreshed first if it is about to expire"""
+        token = session.token
+        if token and session.refresh_at and time.time() > session.refresh_at:
+            await self.refresh(token)
+            token = session.token
+        return token
+
+    async def refresh(self, stale_token):
+        """Single-flight token refresh, see `auth.refresh`"""
+        async with self.refresh_lock:
+            if session.token != stale_token:
+                return True
+            if not session.refresh_token:
+                return False
+            data = {'grant_type': 'refresh_token',
+                    'client_id': auth.CLIENT_ID,
+                    'refresh_token': session.refresh_token}
+            try:
+                async with self.client_session.post(
+                        auth.get_token_url(), data=data) as res:
+                    if res.status != 200:
+                        logger.debug(f'Token refresh failed: {res.status}')
+                        return False
+                    token_response = await res.json(content_type=None)
+            except TRANSFER_ERRORS as err:
+                logger.debug(err, exc_info=True)
+                return False
+            session.update(auth.get_token_info(token_response))
+            return True
+
+    @asynccontextmanager
+    async def request(self, method, url, headers=None, data=None, **kwargs):
+        """Sends an authorized request and yields its response.
+        A 401 answer is retried once after refreshing the token.
+        Idempotent requests and requests with a callable `data`, returning
+        a new body for every attempt, are retried with backoff after
+        connection errors and 5xx answers"""
+        retries = config.http_retries \
+            if method.upper() in http.IDEMPOTENT_METHODS or callable(data) \
+            else 0
+        async with self.semaphore:
+            attempt = 0
+            refreshed = False
+            while True:
+                if attempt:
+                    await asyncio.sleep(
+                        config.http_backoff_factor * 2 ** attempt)
+                token = await self.get_token()
+                try:
+                    res = await self.client_session.request(
+                        method, url, data=data() if callable(data) else data,
+                        headers={**(headers or {}), 'Authorization': token},
+                        **kwargs)
+                except TRANSFER_ERRORS as err:
+                    if attempt >= retries:
+                        raise
+                    logger.debug(err, exc_info=True)
+                    attempt += 1
+                    continue
+                if res.status == 401 and not refreshed:
+                    res.release()
+                    refreshed = True
+                    if await self.refresh(token):
+                        continue
+                    http.login_and_retry()
+                if res.status == 401:
+                    res.release()
+                    http.login_and_retry()
+                if res.status in http.RETRY_STATUSES and attempt < retries:
+                    res.release()
+                    attempt += 1
+                    continue
+                break
+            try:
+                yield res
+            finally:
+                res.release()
+
+    async def fetch_node(self, node_id):
+        """Returns (node, breadcrumbs) tuple, see `nodes.fetch_node`"""
+        cached = node_cache.get_node(node_id)
+        if cached and cached['fresh']:
+            return cached['node'], cached['breadcrumbs']
+
+        headers = {}
+        if cached and cached['etag']:
+            headers['If-None-Match'] = cached['etag']
+        if cached and cached['last_modified']:
+            headers['If-Modified-Since'] = cached['last_modified']
+
+        url = f'{config.web_core_api_url}/nodes/{node_id}'
+        async with self.request('get', url, headers=headers) as res:
+            if res.status == 304 and cached:
+                node_cache.touch_node(node_id)
+                return cached['node'], cached['breadcrumbs']
+            if res.status != 200:
+                node_cache.invalidate(node_id)
+                logger.error('Node with ID {%s} not found' % node_id)
+                return None, None
+            node = await res.json(content_type=None)
+            breadcrumbs = json.loads(res.headers.get('X-Breadcrumbs') or '[]')
+            node_cache.put_node(node_id, node, breadcrumbs,
+                                res.headers.get('ETag'),
+                                res.headers.get('Last-Modified'))
+        node_cache.put_child_ids(
+            nodes.get_breadcrumbs_child_ids(node, breadcrumbs))
+        return node, breadcrumbs
+
+    async def get_page(self, url):
+        """Returns (pagination, nodes) of a listing page, nodes are None
+        if the page could not be read"""
+        async with self.request('get', url) as res:
+            if res.status != 200 or 'X-Pagination' not in res.headers:
+                return {}, None
+            return (json.loads(res.headers['X-Pagination']),
+                    await res.json(content_type=None))
+
+    async def get_nodes(self, remote_folder_id=None, use_cache=True):
+        """Returns child nodes of the folder.
+        Pages after the first one are all requested at once"""
+        remote_folder_id = remote_folder_id or session.cwd
+        cached_nodes = use_cache and node_cache.get_listing(remote_folder_id)
+        if cached_nodes:
+            return cached_nodes
+
+        url = f'{config.web_core_api_url}/nodes/{remote_folder_id}/nodes?pageSize={config.page_size}&pageNumber=%s'
+        (pages, listing) = await self.get_page(url % 1)
+        if listing is None:
+            logger.error("Couldn't get nodes")
+            return []
+        if 'totalPages' in pages:
+            next_pages = await asyncio.gather(*[
+                self.get_page(url % x)
+                for x in range(2, int(pages['totalPages']) + 1)])
+        else:
+            next_pages = []
+            while pages.get('nextPageLink'):
+                (pages, page) = await self.get_page(pages['nextPageLink'].replace(
+                    'http://api.leanda.io/api', config.web_core_api_url))
+                next_pages.append((pages, page))
+        for (_, page) in next_pages:
+            if page is None:
+                logger.error("Couldn't get nodes")
+                return listing
+            listing.extend(page)
+        node_cache.put_listing(remote_folder_id, listing)
+        return listing
+
+    async def walk(self, folder_node, local_folder):
+        """Yields (local folder, child nodes) tuples of the remote tree
+        mirrored into the local folder. All known folders are listed
+        concurrently"""
+
+        async def list_folder(folder_node, local_folder):
+            return local_folder, await self.get_nodes(folder_node['id'])
+
+        pending = {asyncio.ensure_future(list_folder(
+            folder_node, path.join(local_folder, folder_node.get('name', ''))))}
+        try:
+            while pending:
+                (done, pending) = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    (local_folder, children) = task.result()
+                    for node in children:
+                        if node['type'] == 'Folder':
+                            pending.add(asyncio.ensure_future(list_folder(
+                                node, path.join(local_folder, node['name']))))
+                    yield local_folder, children
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def create_folder(self, name, remote_folder_id=None):
+        url = f'{config.web_core_api_url}/entities/folders'
+        data = {"Name": name, "ParentId": remote_folder_id or session.cwd}
+        headers = {'Content-Type': 'application/json'}
+        async with self.request('post', url, headers=headers,
+                                data=json.dumps(data)) as res:
+            if res.status != 202:
+                logger.error('Cannot create remote folder')
+                return None
+            id = res.headers['Location'][-36:]
+        node_cache.invalidate_listing(data['ParentId'])
+        logger.info(f'Folder "{name}" {{{id}}} successfully created')
+        return id
+
+    async def remove_nodes(self, nodes_to_remove, remote_folder_id=None):
+        """Removes nodes with one PATCH request per
+        `config.remove_batch_size` nodes, all batches at once.
+        Returns list of (node, removed) tuples"""
+        batch_size = config.remove_batch_size
+        url = f'{config.web_core_api_url}/nodecollections'
+        headers = {'Content-Type': 'application/json'}
+
+        async def remove_batch(batch):
+            data = [{'value': [{'id': x['id'], 'type': x.get('type') or 'File'}
+                               for x in batch],
+                     'path': '/deleted',
+                     'op': 'add'}]
+            async with self.request('patch', url, headers=headers,
+                                    data=json.dumps(data)) as res:
+                removed = res.status == 202
+            for node in batch:
+                if removed:
+                    node_cache.invalidate(node['id'])
+                    node_cache.invalidate_listing(
+                        node.get('parentId') or remote_folder_id)
+                    logger.info('Node "%s" {%s} was removed!' % (
+                        node['name'], node['id']))
+                else:
+                    logger.error('Couldn\'t remove node {%s}' % node['id'])
+            return [(node, removed) for node in batch]
+
+        batches = await asyncio.gather(*[
+            remove_batch(nodes_to_remove[i:i + batch_size])
+            for i in range(0, len(nodes_to_remove), batch_size)])
+        return util.flatten_2d_list(batches)
+
+    async def upload_file(self, file_path, remote_folder_id,
+                          replaced_nodes=(), mode=None, checksum=False,
+                          chunk_callback=None):
+        """Streams the file to the folder, see `blobs.prepare_file` for
+        `replaced_nodes` and `mode`. Returns (status, reason) tuple"""
+        chunk_callback = chunk_callback or (lambda size: None)
+        file_stat = os.stat(file_path)
+        data = {'parentId': remote_folder_id,
+                'created': str(file_stat.st_ctime_ns),
+                'modified': str(file_stat.st_mtime_ns),
+                'accessed': str(file_stat.st_atime_ns)}
+        url = f'{config.web_blob_api_url}/blobs/{session.owner}'
+
+        if file_stat.st_size > config.file_upload_limit_int and \
+                config.file_limit_policy == 'skip':
+            return SKIPPED, f'larger than {config.file_upload_limit}'
+        if mode and await asyncio.get_running_loop().run_in_executor(
+                None, blobs.is_uploaded, file_path, file_stat,
+                replaced_nodes, mode, checksum):
+            chunk_callback(file_stat.st_size)
+            return SKIPPED, 'already uploaded'
+
+        mime_type = http.get_mime_type(file_path)
+        files = []
+        bytes_read = 0
+
+        def progress_callback(size):
+            nonlocal bytes_read
+            bytes_read += size
+            chunk_callback(size)
+
+        def get_form():
+            # every attempt sends the file from the start
+            nonlocal bytes_read
+            chunk_callback(-bytes_read)
+            bytes_read = 0
+            form = aiohttp.FormData(data)
+            files.append(ProgressReader(
+                io.FileIO(file_path, 'r'), progress_callback))
+            form.add_field('file', files[-1], content_type=mime_type,
+                           filename=path.basename(file_path))
+            return form
+
+        try:
+            async with self.request('post', url, data=get_form) as res:
+                (status, reason) = (res.status, res.reason)
+        finally:
+            for file in files:
+                file.close()
+        if status != 200:
+            return FAILED, reason
+        node_cache.invalidate_listing(remote_folder_id)
+        return UPLOADED, None
+
+    async def download_file(self, file_node, local_folder,
+                            chunk_callback=None):
+        """Streams the file node into the local folder through a part file,
+        see `http.get_part_path`, resumed after interruptions.
+        Returns (status, reason) tuple"""
+        chunk_callback = chunk_callback or (lambda size: None)
+        if file_node['type'] != 'File':
+            return SKIPPED, 'node type is not a file'
+        if not file_node['blob']:
+            return SKIPPED, 'no blob data for node'
+
+        length = int(file_node['blob']['length'])
+        if length > config.file_download_limit_int and \
+                config.file_limit_policy == 'skip':
+            return SKIPPED, f'larger than {config.file_download_limit}'
+
+        url = f'{config.web_core_api_url}/entities/files/{file_node["id"]}/blobs/{file_node["blob"]["id"]}'
+        file_path = path.join(local_folder, file_node['name'])
+        part_path = http.get_part_path(file_path, file_node['blob']['id'])
+        offset = path.getsize(part_path) if path.isfile(part_path) else 0
+        if offset > length:
+            offset = 0
+        chunk_callback(offset)
+
+        last_error = None
+        for attempt in range(config.http_retries + 1):
+            if offset == length and path.isfile(part_path):
+                os.replace(part_path, file_path)
+                return DOWNLOADED, None
+            if attempt:
+                await asyncio.sleep(config.http_backoff_factor * 2 ** attempt)
+            headers = {'Content-Disposition': 'attachment'}
+            if offset:
+                headers['Range'] = f'bytes={offset}-'
+            try:
+                async with self.request('get', url, headers=headers) as res:
+                    if res.status not in [200, 206]:
+                        return FAILED, res.reason
+                    if res.status == 200 and offset:
+                        chunk_callback(-offset)
+                        offset = 0
+                    with open(part_path, 'ab' if offset else 'wb') as f:
+                        async for chunk in res.content.iter_chunked(
+                                config.download_chunk_size):
+                            f.write(chunk)
+                            offset += len(chunk)
+                            chunk_callback(len(chunk))
+                if offset == length:
+                    continue
+                last_error = f'received {offset} of {length} bytes'
+            except TRANSFER_ERRORS as err:
+                logger.debug(err, exc_info=True)
+                last_error = err
+        if offset == length and path.isfile(part_path):
+            os.replace(part_path, file_path)
+            return DOWNLOADED, None
+        return FAILED, f'Download interrupted: {last_error}'
+
+
+class Uploader(blobs.Transfer):
+    """Uploads files with `jobs` concurrent uploads, see `blobs.Uploader`.
+    Remote folders are created level by level, each remote folder
+    is listed once"""
+
+    def __init__(self, client, remote_folder_id=None, jobs=1, mode=None,
+                 checksum=False):
+        super().__init__(jobs)
+        self.client = client
+        self.remote_folder_id = remote_folder_id or session.cwd
+        self.mode = mode
+        self.checksum = checksum
+        self.listings = {}
+        self.replaced_nodes = []
+
+    async def run(self, levels, files_by_folder):
+        folder_ids = await self.create_folders(levels)
+        work_queue = asyncio.Queue(maxsize=self.jobs * 2)
+        with tqdm(total=0, unit='B', unit_scale=True,
+                  desc='Uploading') as self.pbar:
+            workers = [asyncio.ensure_future(self.work(work_queue))
+                       for _ in range(self.jobs)]
+            try:
+                for (folder_path, file_paths) in files_by_folder.items():
+                    for file_path in file_paths:
+                        if self.error:
+                            break
+                        await self.scan(
+                            work_queue, file_path, folder_ids.get(folder_path))
+                for _ in workers:
+                    await work_queue.put(None)
+                await asyncio.gather(*workers)
+            finally:
+                for worker in workers:
+                    worker.cancel()
+
+        self.raise_error()
+        if self.replaced_nodes:
+            await self.client.remove_nodes(self.replaced_nodes)
+        blobs.print_transfer_summary(self.results)
+        return self.results
+
+    def get_listing(self, remote_folder_id):
+        """Returns future of the folder listing, requested once"""
+        if remote_folder_id not in self.listings:
+            self.listings[remote_folder_id] = asyncio.ensure_future(
+                self.client.get_nodes(remote_folder_id, False))
+        return self.listings[remote_folder_id]
+
+    async def create_folders(self, levels):
+        """Creates remote folders level by level, concurrently within
+        a level. Returns local path to remote folder id map"""
+        folder_ids = {None: self.remote_folder_id}
+
+        async def get_folder_id(folder_path, parent_path):
+            parent_id = folder_ids.get(parent_path)
+            if not parent_id:
+                return None
+            name = path.basename(folder_path)
+            for node in await self.get_listing(parent_id):
+                if node['type'] == 'Folder' and node['name'] == name:
+                    return node['id']
+            folder_id = await self.client.create_folder(name, parent_id)
+            if folder_id:
+                self.listings[folder_id] = \
+                    asyncio.get_running_loop().create_future()
+                self.listings[folder_id].set_result([])
+            return folder_id
+
+        for level in levels:
+            folder_ids.update(zip([x[0] for x in level], await asyncio.gather(
+                *[get_folder_id(*x) for x in level])))
+        return folder_ids
+
+    async def scan(self, work_queue, file_path, remote_folder_id):
+        if remote_folder_id is None:
+            self.add_result(file_path, FAILED, 'Remote folder not created')
+            return
+        if not path.isfile(file_path):
+            self.add_result(file_path, FAILED, 'File not found')
+            return
+        with self.lock:
+            self.files_count += 1
+            self.pbar.total += path.getsize(file_path)
+            self.pbar.refresh()
+        await work_queue.put((file_path, remote_folder_id))
+
+    async def work(self, work_queue):
+        while True:
+            item = await work_queue.get()
+            if item is None:
+                return
+            if self.error:
+                continue
+            (file_path, remote_folder_id) = item
+            try:
+                replaced_nodes = [
+                    x for x in await self.get_listing(remote_folder_id)
+                    if x['name'] == path.basename(file_path)]
+                (status, reason) = await self.client.upload_file(
+                    file_path, remote_folder_id, replaced_nodes, self.mode,
+                    self.checksum, self.update_progress)
+                if status == UPLOADED:
+                    self.replaced_nodes.extend(replaced_nodes)
+            except http.AuthorizationError as err:
+                # the remaining items are drained, see `blobs.Transfer`
+                self.error = self.error or err
+                continue
+            except Exception as err:
+                logger.debug(err, exc_info=True)
+                (status, reason) = (FAILED, str(err) or type(err).__name__)
+            self.add_result(file_path, status, reason)
+
+
+class Downloader(blobs.Transfer):
+    """Mirrors remote folder tree into local folder with `jobs`
+    concurrent downloads while the tree is listed concurrently,
+    see `blobs.Downloader`"""
+
+    def __init__(self, client, jobs=1):
+        super().__init__(jobs)
+        self.client = client
+
+    async def run(self, folder_node, local_folder):
+        work_queue = asyncio.Queue(maxsize=self.jobs * 4)
+        with tqdm(total=0, unit='B', unit_scale=True,
+                  desc='Downloading') as self.pbar:
+            workers = [asyncio.ensure_future(self.work(work_queue))
+                       for _ in range(self.jobs)]
+            try:
+                async for (local_folder, children) in self.client.walk(
+                        folder_node, path.abspath(local_folder)):
+                    os.makedirs(local_folder, exist_ok=True)
+                    for node in children:
+                        if self.error:
+                            break
+                        if node['type'] != 'Folder':
+                            await self.scan(work_queue, node, local_folder)
+                for _ in workers:
+                    await work_queue.put(None)
+                await asyncio.gather(*workers)
+            finally:
+                for worker in workers:
+                    worker.cancel()
+
+        self.raise_error()
+        blobs.print_transfer_summary(self.results)
+        return self.results
+
+    async def scan(self, work_queue, file_node, local_folder):
+        with self.lock:
+            self.files_count += 1
+            if file_node.get('blob'):
+                self.pbar.total += int(file_node['blob']['length'])
+                self.pbar.refresh()
+        await work_queue.put((file_node, local_folder))
+
+    async def work(self, work_queue):
+        while True:
+            item = await work_queue.get()
+            if item is None:
+                return
+            if self.error:
+                continue
+            (file_node, local_folder) = item
+            try:
+                (status, reason) = await self.client.download_file(
+                    file_node, local_folder, self.update_progress)
+            except http.AuthorizationError as err:
+                # the remaining items are drained, see `blobs.Transfer`
+                self.error = self.error or err
+                continue
+            except Exception as err:
+                logger.debug(err, exc_info=True)
+                (status, reason) = (FAILED, str(err) or type(err).__name__)
+            self.add_result(
+                path.join(local_folder, file_node['name']), status, reason)
+
+
+async def print_cwd_nodes(show_id):
+    async with Client() as client:
+        nodes.print_cwd_nodes(show_id, await client.get_nodes())
+
+
+async def remove(node_names_or_ids, remote_folder_id=None):
+    """Removes nodes by names in remote folder or by ids,
+    see `nodes.remove`"""
+    remote_folder_id = remote_folder_id or session.cwd
+    async with Client() as client:
+        ids = [x for x in node_names_or_ids if util.is_valid_uuid4(x)]
+        names = set(node_names_or_ids) - set(ids)
+        found_nodes = [node for (node, _) in await asyncio.gather(
+            *[client.fetch_node(x) for x in ids]) if node]
+        if names:
+            found_nodes.extend(
+                x for x in await client.get_nodes(remote_folder_id, False)
+                if x['name'] in names)
+        if not found_nodes:
+            print('No nodes to remove')
+            return
+        return await client.remove_nodes(found_nodes, remote_folder_id)
+
+
+async def upload(local_paths, remote_folder_id=None, jobs=1, mode=None,
+                 checksum=False):
+    """Upload directory of files (can be used with glob patterns)"""
+    local_paths = local_paths or [os.getcwd()]
+    (directories, files) = util.get_normalized_paths(local_paths)
+    (levels, files_by_folder) = blobs.plan_upload(directories, files)
+    async with Client() as client:
+        return await Uploader(
+            client, remote_folder_id, jobs, mode, checksum).run(
+                levels, files_by_folder)
+
+
+async def download(remote_folder_id=None, local_folder=None, jobs=1):
+    async with Client() as client:
+        (folder_node, _) = await client.fetch_node(
+            remote_folder_id or session.cwd)
+        if not folder_node:
+            return
+        if folder_node['type'] not in ['Folder', 'User']:
+            print('Node type is not a folder')
+            return
+        return await Downloader(client, jobs).run(
+            folder_node, local_folder or os.getcwd())
@@ -1,34 +1,113 @@
 import json
 import logging
-import requests
+import threading
+import time
 
+from leanda.api import http
 from leanda.config import config
 from leanda.session import session
 
 logger = logging.getLogger('auth')
 
+CLIENT_ID = 'leanda_cli'
+# seconds before expiry the access token is refreshed
+REFRESH_MARGIN = 30
+
+refresh_lock = threading.Lock()
+
+
+def get_token_url():
+    return f'{config.identity_server_url}/protocol/openid-connect/token'
+
 
 def login(username, password):
-    token_url = f'{config.identity_server_url}/protocol/openid-connect/token'
     me_url = f'{config.web_core_api_url}/me'
     data = {'grant_type': 'password',
-            'client_id': 'leanda_cli',
+            'client_id': CLIENT_ID,
             'username': username, 'password': password, }
     try:
-        res = requests.post(token_url, data=data)
-    except requests.exceptions.ConnectionError as err:
+        res = http.transport.post(get_token_url(), data=data)
+    except http.get_transfer_errors() as err:
         logger.exception(err)
         exit()
     assert res.ok, 'Authorization Error'
 
-    token = '{token_type} {access_token}'.format(**res.json())
+    token_info = get_token_info(res.json())
     headers = {
         'Accept': 'application/json',
-        'Authorization': token
+        'Authorization': token_info['token']
     }
-    res = requests.get(me_url, headers=headers)
+    res = http.transport.get(me_url, headers=headers)
     owner = res.json()['id']
-    info = {'token': token, 'cwd': owner, 'owner': owner, 'user': res.json()}
+    info = {**token_info, 'cwd': owner, 'owner': owner, 'user': res.json()}
     session.update(info)
     logger.info('Logged in as {firstName} {lastName}'.format(**res.json()))
     return res.json()
+
+
+def get_token_info(token_response):
+    """Returns session data of the identity server token response:
+    the access token, the refresh token and when to refresh"""
+    expires_in = token_response.get('expires_in')
+    refresh_at = expires_in and time.time() + max(
+        expires_in - REFRESH_MARGIN, expires_in * 0.75)
+    return {'token': '{token_type} {access_token}'.format(**token_response),
+            'refresh_token': token_response.get('refresh_token'),
+            'refresh_at': refresh_at}
+
+
+def get_token():
+    """Returns the access token, refreshed first if it is about to expire"""
+    token = session.token
+    refresh_at = session.refresh_at
+    if token and refresh_at and time.time() > refresh_at:
+        refresh(token)
+        token = session.token
+    return token
+
+
+def refresh(stale_token=None):
+    """Exchanges the refresh token for a new access token.
+
+    Concurrent callers share one refresh: callers waiting for it find
+    their `stale_token` already replaced and return at once.
+    Returns False if the session cannot be refreshed.
+    """
+    with refresh_lock:
+        if stale_token and session.token != stale_token:
+            return True
+        refresh_token = session.refresh_token
+        if not refresh_token:
+            return False
+        data = {'grant_type': 'refresh_token',
+                'client_id': CLIENT_ID,
+                'refresh_token': refresh_token}
+        try:
+            res = http.transport.post(get_token_url(), data=data)
+        except http.get_transfer_errors() as err:
+            logger.debug(err, exc_info=True)
+            return False
+        if not res.ok:
+            logger.debug(f'Token refresh failed: {res.status_code} {res.text}')
+            return False
+        session.update(get_token_info(res.json()))
+        logger.debug('Access token refreshed')
+        return True
+
+
+def keep_fresh(interval=60):
+    """Refreshes the access token in the background before it expires,
+    so idle long running processes keep their session alive.
+    The session is re-read every `interval` seconds at most, picking
+    up tokens refreshed by other processes"""
+
+    def run():
+        while True:
+            refresh_at = session.refresh_at
+            delay = refresh_at and refresh_at - time.time()
+            if not session.refresh_token or delay is None or delay > 0:
+                time.sleep(min(delay or interval, interval))
+            elif not refresh(session.token):
+                time.sleep(interval)
+
+    threading.Thread(target=run, daemon=True).start()
@@ -1,23 +1,24 @@
 import os
-import requests
+import queue
+import shutil
+import signal
+import threading
 import time
 import logging
-from requests_toolbelt import MultipartEncoder
-from time import ctime
 from os import path, walk
-from glob import glob
+from collections import deque
+from contextlib import contextmanager
 from colorama import Fore
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 from pathlib import Path
-from watchdog.observers import Observer
-from watchdog import events
-from datetime import datetime
-from signalrcore.hub_connection_builder import HubConnectionBuilder
 
 from leanda import util
+from leanda.cache import node_cache
 from leanda.config import config
 from leanda.session import session
-from leanda.api import http, nodes
+from leanda.syncstate import LEGACY_SYNC_FILE, SyncState
+from leanda.api import auth, http, hub, nodes
 
 logger = logging.getLogger('blobs')
 
@@ -27,18 +28,145 @@ def get_info(blob_id):
     return http.get(url)
 
 
-def upload_file(file_path, remote_folder_id=None):
-    file_path = path.abspath(file_path)
-    if not path.isfile(file_path):
-        print(f'File {file_path} not found')
-        return
-    file_stat = Path(file_path).stat()
+UPLOADED, DOWNLOADED, FAILED, SKIPPED = (
+    'Uploaded', 'Downloaded', 'Failed', 'Skipped')
+SKIP_EXISTING, UPDATE = ('skip-existing', 'update')
+
+
+def get_blob_metadata(blob):
+    """Returns blob metadata, requests blob info if the listing
+    did not include it"""
+    metadata = blob.get('metadata')
+    if metadata is None:
+        res = get_info(blob['id'])
+        metadata = res is not None and res.ok and \
+            res.json().get('metadata') or {}
+    return metadata
+
+
+def is_uploaded(file_path, file_stat, remote_nodes, mode, checksum=False):
+    """Checks same-named remote nodes for a copy of the file.
+    SKIP_EXISTING accepts any remote file, UPDATE one with the same size
+    and modification time and, with `checksum`, the same MD5"""
+    remote_files = [x for x in remote_nodes
+                    if x['type'] == 'File' and x.get('blob')]
+    if mode == SKIP_EXISTING:
+        return bool(remote_files)
+    for node in remote_files:
+        blob = node['blob']
+        if int(blob['length']) != file_stat.st_size:
+            continue
+        metadata = get_blob_metadata(blob)
+        if str(metadata.get('modified')) != str(file_stat.st_mtime_ns):
+            continue
+        if checksum:
+            md5 = blob.get('md5') or metadata.get('md5')
+            if not md5 or \
+                    md5.lower() != util.get_file_hash(file_path, 'md5'):
+                continue
+        return True
+    return False
+
+
+def put_file(file_path, remote_folder_id=None, chunk_callback=None,
+             folder_index=None, remover=None, mode=None, checksum=False):
+    """Uploads file replacing remote nodes with the same name.
+    Replaced nodes are removed right away or handed to `remover`.
+    With SKIP_EXISTING or UPDATE `mode` files already uploaded
+    are skipped (see `is_uploaded`).
+    Returns (status, reason) tuple"""
+    (status, reason, upload) = prepare_file(
+        file_path, remote_folder_id, folder_index, mode, checksum,
+        chunk_callback=chunk_callback)
+    if status:
+        return status, reason
+    return send_file(upload, chunk_callback, remover)
+
+
+def prepare_file(file_path, remote_folder_id=None, folder_index=None,
+                 mode=None, checksum=False, file_stat=None, mime_type=None,
+                 chunk_callback=None):
+    """Everything `put_file` does before sending the file: finds the
+    nodes it replaces, applies the limit policy and upload mode and
+    reads small files into memory.
+    Returns (status, reason, upload) tuple, status is None unless
+    the file is not to be sent"""
+    file_stat = file_stat or Path(file_path).stat()
     data = {'parentId': remote_folder_id or session.cwd,
             'created': str(file_stat.st_ctime_ns),
             'modified': str(file_stat.st_mtime_ns),
             'accessed': str(file_stat.st_atime_ns)}
     url = f'{config.web_blob_api_url}/blobs/{session.owner}'
 
+    file_size = file_stat.st_size
+    if file_size > config.file_upload_limit_int and \
+            config.file_limit_policy == 'skip':
+        return SKIPPED, f'larger than {config.file_upload_limit}', None
+
+    folder_index = folder_index or nodes.FolderIndex(remote_folder_id)
+    remove_after_upload = folder_index.get(path.basename(file_path))
+    if mode and is_uploaded(file_path, file_stat, remove_after_upload, mode,
+                            checksum):
+        if chunk_callback:
+            chunk_callback(file_size)
+        return SKIPPED, 'already uploaded', None
+
+    upload = {'url': url, 'file_path': file_path, 'data': data,
+              'size': file_size, 'mime_type': mime_type, 'encoded': None,
+              'folder_index': folder_index, 'replaced': remove_after_upload}
+    if file_size < 1024 * 1024 * 1:  # 1 MB
+        upload['encoded'] = http.encode_small_file(file_path, data, mime_type)
+    return None, None, upload
+
+
+def send_file(upload, chunk_callback=None, remover=None):
+    """Sends file prepared by `prepare_file` and removes the nodes
+    it replaces. Returns (status, reason) tuple"""
+    try:
+        if upload['encoded']:
+            res = http.upload_small_file(
+                upload['url'], upload['file_path'], upload['data'],
+                upload['encoded'])
+            if chunk_callback:
+                chunk_callback(upload['size'])
+        else:
+            res = http.upload_large_file(
+                upload['url'], upload['file_path'], upload['data'],
+                chunk_callback, upload['mime_type'])
+    except http.UploadError as err:
+        return FAILED, str(err)
+
+    if res is None:
+        return FAILED, 'File not found'
+    if res.status_code != 200:
+        return FAILED, res.reason
+    folder_index = upload['folder_index']
+    remove_after_upload = upload['replaced']
+    node_cache.invalidate_listing(folder_index.remote_folder_id)
+    for node in remove_after_upload:
+        folder_index.discard(node)
+    if remover:
+        remover.add(remove_after_upload)
+    elif remove_after_upload:
+        nodes.remove_nodes(remove_after_upload, folder_index.remote_folder_id)
+    return UPLOADED, None
+
+
+def get_status_bar_format(status, reason, action):
+    if status in [UPLOADED, DOWNLOADED]:
+        return '%s{desc}%s%s' % (Fore.GREEN, status, Fore.RESET)
+    if status == SKIPPED:
+        return '%s{desc}Skipped (%s)%s' % (Fore.YELLOW, reason, Fore.RESET)
+    return '%s{desc}Failed when %s. Reason:%s%s' % (
+        Fore.RED, action, reason, Fore.RESET)
+
+
+def upload_file(file_path, remote_folder_id=None, folder_index=None):
+    file_path = path.abspath(file_path)
+    if not path.isfile(file_path):
+        print(f'File {file_path} not found')
+        return
+
     file_size = path.getsize(file_path)
     with tqdm(total=file_size, bar_format='{l_bar}{bar}|') as pbar:
         truncate_length = 50
@@ -46,66 +174,296 @@ def upload_file(file_path, remote_folder_id=None):
         desc = desc.ljust(truncate_length, ' ')
         pbar.set_description(desc)
 
-        if file_size > config.file_upload_limit_int:
-            pbar.bar_format = '%s{desc}Skipped (larger than %s)%s' % (
-                Fore.YELLOW, config.file_upload_limit, Fore.RESET)
-            pbar.clear()
-            return
+        status, reason = put_file(
+            file_path, remote_folder_id, pbar.update, folder_index)
 
-        basename = path.basename(file_path)
-        nodes_with_the_same_name = nodes.get_nodes(remote_folder_id)
-        remove_after_upload = list(filter(
-            lambda x: x['name'] == basename, nodes_with_the_same_name))
-
-        if file_size < 1024 * 1024 * 1:  # 1 MB
-            res = http.upload_small_file(url, file_path, data)
-        else:
-            res = http.upload_large_file(url, file_path, data, pbar.update)
-
-        if res.status_code == 200:
-            pbar.bar_format = '%s{desc}Uploaded%s' % (
-                Fore.GREEN, Fore.RESET)
-        else:
-            pbar.bar_format = '%s{desc}Failed when upload. Reason:%s%s' % (
-                Fore.RED, res.reason, Fore.RESET)
+        pbar.bar_format = get_status_bar_format(status, reason, 'upload')
         pbar.clear()
-        for node in remove_after_upload:
-            nodes.remove(node['id'])
-        return res
+        return status
 
 
-def upload_files(local_files, remote_folder_id=None):
-    local_files = map(lambda x: path.abspath(x), local_files)
-    local_files = list(set(local_files))
-    for file_path in local_files:
-        upload_file(file_path, remote_folder_id)
+def print_transfer_summary(results):
+    """Prints failed and skipped files followed by totals per status"""
+    totals = {}
+    for (file_path, status, reason) in results:
+        totals[status] = totals.get(status, 0) + 1
+        if status == FAILED:
+            print('%s%s: %s%s' % (Fore.RED, file_path, reason, Fore.RESET))
+        elif status == SKIPPED:
+            print('%s%s: Skipped (%s)%s' % (
+                Fore.YELLOW, file_path, reason, Fore.RESET))
+    print(', '.join(f'{status}: {count}' for status,
+                    count in sorted(totals.items())) or 'Nothing to transfer')
 
 
-def upload_directories(local_folders, remote_folder_id=None):
-    local_folders = list(set(local_folders))
-    for folder_path in local_folders:
+def plan_upload(directories, files):
+    """Walks local directories once.
+    Returns folders grouped into levels of (path, parent path) tuples,
+    parents first, and files grouped by local parent folder
+    (None for remote destination folder)"""
+    levels = []
+    depths = {None: -1}
+    files_by_folder = {None: [path.abspath(x) for x in set(files)]}
+    for folder_path in set(directories):
         folder_path = path.abspath(folder_path)
-        id = nodes.create_folder(path.basename(folder_path), remote_folder_id)
-        if not id:
-            logger.error('Couldn\'t create folder with ID {%s}' % id)
-            continue
+        folders = [(folder_path, None)]
         for (dirpath, dirnames, filenames) in walk(folder_path):
-            local_files = map(lambda x: path.join(
-                folder_path, x), filenames)
-            local_folders = map(
-                lambda x: path.join(folder_path, x), dirnames)
-            upload_files(list(local_files), id)
-            upload_directories(local_folders, id)
-            break
+            folders.extend((path.join(dirpath, x), dirpath) for x in dirnames)
+            files_by_folder[dirpath] = [
+                path.join(dirpath, x) for x in filenames]
+        for (folder_path, parent_path) in folders:
+            depth = depths[folder_path] = depths[parent_path] + 1
+            if depth == len(levels):
+                levels.append([])
+            levels[depth].append((folder_path, parent_path))
+    return levels, files_by_folder
+
+
+class Transfer():
+    """Aggregate progress bar and per-file results of a bulk transfer.
+
+    Workers run through `guard`: the first error a worker does not
+    handle, e.g. AuthorizationError, is kept in `error` and the worker
+    goes on draining its queue, so producers never block on a full
+    queue. The thread feeding the queues stops once `error` is set
+    and raises it after the workers are stopped (see `raise_error`).
+    """
+
+    def __init__(self, jobs=1):
+        self.jobs = max(jobs or 1, 1)
+        self.results = []
+        self.files_count = 0
+        self.lock = threading.Lock()
+        self.pbar = None
+        self.error = None
+        http.transport.ensure_pool_size(self.jobs + 1)
+
+    def start_workers(self, target, work_queue, count):
+        workers = [threading.Thread(target=self.guard,
+                                    args=(target, work_queue), daemon=True)
+                   for _ in range(count)]
+        for worker in workers:
+            worker.start()
+        return workers
 
+    def stop_workers(self, work_queue, workers):
+        for _ in workers:
+            work_queue.put(None)
+        for worker in workers:
+            worker.join()
 
-def upload(local_paths, remote_folder_id):
+    def guard(self, target, work_queue):
+        try:
+            target()
+        except BaseException as error:
+            logger.debug(error, exc_info=True)
+            with self.lock:
+                self.error = self.error or error
+            while work_queue.get() is not None:
+                pass
+
+    def raise_error(self):
+        if self.error:
+            raise self.error
+
+    def update_progress(self, size):
+        with self.lock:
+            self.pbar.update(size)
+
+    def add_result(self, file_path, status, reason=None):
+        with self.lock:
+            self.results.append((file_path, status, reason))
+            if self.pbar is not None:
+                self.pbar.set_postfix_str(
+                    f'{len(self.results)}/{self.files_count} files')
+
+
+class Uploader(Transfer):
+    """Uploads files through a pipeline of stages connected by bounded
+    queues with one aggregate progress bar:
+    scan (stat and MIME type) runs in the calling thread,
+    prepare (remote folder listing, upload mode, reading small files)
+    and send run in pools of workers, so disk and network work overlap.
+    Time spent in every stage is summed up in `http.upload_timings`"""
+
+    def __init__(self, remote_folder_id=None, jobs=1, mode=None,
+                 checksum=False):
+        super().__init__(jobs)
+        self.remote_folder_id = remote_folder_id or session.cwd
+        self.mode = mode
+        self.checksum = checksum
+        self.folder_indexes = nodes.FolderIndexes()
+        self.remover = nodes.BatchRemover()
+        self.prepare_jobs = max(self.jobs // 2, 1)
+        self.prepare_queue = queue.Queue(maxsize=self.jobs * 2)
+        self.send_queue = queue.Queue(maxsize=self.jobs * 2)
+        http.transport.ensure_pool_size(self.jobs + self.prepare_jobs + 1)
+
+    @contextmanager
+    def timed(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                http.upload_timings[stage] += time.perf_counter() - started
+
+    def run(self, directories, files):
+        levels, files_by_folder = plan_upload(directories, files)
+        folder_ids = self.create_folders(levels)
+
+        with tqdm(total=0, unit='B', unit_scale=True,
+                  desc='Uploading') as self.pbar:
+            preparers = self.start_workers(
+                self.prepare, self.prepare_queue, self.prepare_jobs)
+            senders = self.start_workers(
+                self.send, self.send_queue, self.jobs)
+            try:
+                for (folder_path, file_paths) in files_by_folder.items():
+                    for file_path in file_paths:
+                        if self.error:
+                            break
+                        self.scan(file_path, folder_ids.get(folder_path))
+            finally:
+                self.stop_workers(self.prepare_queue, preparers)
+                self.stop_workers(self.send_queue, senders)
+        self.raise_error()
+
+        self.remover.flush()
+        print_transfer_summary(self.results)
+        return self.results
+
+    def create_folders(self, levels):
+        """Creates remote folders level by level, concurrently within
+        a level. Existing folders are found in one listing per parent.
+        Returns local path to remote folder id map"""
+        folder_ids = {None: self.remote_folder_id}
+
+        def get_folder_id(folder):
+            (folder_path, parent_path) = folder
+            parent_id = folder_ids.get(parent_path)
+            return parent_id and get_or_create_folder(
+                path.basename(folder_path),
+                self.folder_indexes.get(parent_id), self.folder_indexes)
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            for level in levels:
+                folder_ids.update(zip(
+                    [x[0] for x in level], executor.map(get_folder_id, level)))
+        return folder_ids
+
+    def scan(self, file_path, remote_folder_id):
+        if remote_folder_id is None:
+            self.add_result(file_path, FAILED, 'Remote folder not created')
+            return
+        with self.timed('scan'):
+            file_stat = path.isfile(file_path) and Path(file_path).stat()
+            mime_type = file_stat and http.get_mime_type(file_path)
+        if not file_stat:
+            self.add_result(file_path, FAILED, 'File not found')
+            return
+        with self.lock:
+            self.files_count += 1
+            self.pbar.total += file_stat.st_size
+            self.pbar.refresh()
+        self.prepare_queue.put(
+            (file_path, remote_folder_id, file_stat, mime_type))
+
+    def prepare(self):
+        while True:
+            item = self.prepare_queue.get()
+            if item is None:
+                return
+            if self.error:
+                continue
+            (file_path, remote_folder_id, file_stat, mime_type) = item
+            try:
+                with self.timed('prepare'):
+                    status, reason, upload = prepare_file(
+                        file_path, remote_folder_id,
+                        self.folder_indexes.get(remote_folder_id),
+                        self.mode, self.checksum, file_stat, mime_type,
+                        self.update_progress)
+            except http.AuthorizationError:
+                raise
+            except Exception as err:
+                logger.debug(err, exc_info=True)
+                status, reason = FAILED, str(err)
+            if status:
+                self.add_result(file_path, status, reason)
+            else:
+                self.send_queue.put(upload)
+
+    def send(self):
+        while True:
+            upload = self.send_queue.get()
+            if upload is None:
+                return
+            if self.error:
+                continue
+            try:
+                with self.timed('send'):
+                    status, reason = send_file(
+                        upload, self.update_progress, self.remover)
+            except http.AuthorizationError:
+                raise
+            except Exception as err:
+                logger.debug(err, exc_info=True)
+                status, reason = FAILED, str(err)
+            self.add_result(upload['file_path'], status, reason)
+
+
+def upload_files(local_files, remote_folder_id=None, jobs=1):
+    return Uploader(remote_folder_id, jobs).run([], local_files)
+
+
+def upload_directories(local_folders, remote_folder_id=None, jobs=1):
+    return Uploader(remote_folder_id, jobs).run(local_folders, [])
+
+
+def upload(local_paths, remote_folder_id, jobs=1, mode=None,
+           checksum=False):
     """Upload directory of files (can be used with glob patterns)"""
     local_paths = local_paths or [os.getcwd()]
     (directories, files) = util.get_normalized_paths(local_paths)
 
-    upload_directories(directories, remote_folder_id)
-    upload_files(files, remote_folder_id)
+    return Uploader(remote_folder_id, jobs, mode, checksum).run(
+        directories, files)
+
+
+def get_file(file_node, local_folder, chunk_callback=None):
+    """Downloads file node into local folder.
+    Returns (status, reason) tuple"""
+    if file_node['type'] != 'File':
+        return SKIPPED, 'node type is not a file'
+
+    if not file_node['blob']:
+        return SKIPPED, 'no blob data for node'
+
+    url = f'{config.web_core_api_url}/entities/files/{file_node["id"]}/blobs/{file_node["blob"]["id"]}'
+
+    blob_length = int(file_node['blob']['length'])
+    file_path = path.join(local_folder, file_node['name'])
+    if blob_length > config.file_download_limit_int and \
+            config.file_limit_policy == 'skip':
+        return SKIPPED, f'larger than {config.file_download_limit}'
+
+    try:
+        if config.download_segments > 1 and \
+                blob_length >= config.segmented_download_size:
+            res = http.download_segmented(
+                url, file_path, blob_length, config.download_segments,
+                chunk_callback, file_node['blob']['id'])
+        else:
+            res = http.download_file(
+                url, file_path, chunk_callback, blob_length,
+                file_node['blob']['id'])
+    except http.DownloadError as err:
+        return FAILED, str(err)
+
+    if res is not None and not res.ok:
+        return FAILED, res.reason
+    return DOWNLOADED, None
 
 
 def download_file(file_node, local_folder=None):
@@ -121,7 +479,6 @@ def download_file(file_node, local_folder=None):
         return
 
     local_folder = path.abspath(local_folder or os.getcwd())
-    url = f'{config.web_core_api_url}/entities/files/{file_node["id"]}/blobs/{file_node["blob"]["id"]}'
 
     blob_length = int(file_node['blob']['length'])
     with tqdm(total=blob_length, bar_format='{l_bar}{bar}|') as pbar:
@@ -130,29 +487,78 @@ def download_file(file_node, local_folder=None):
         desc = desc.ljust(truncate_length, ' ')
         pbar.set_description(desc)
 
-        file_path = path.join(local_folder, file_node['name'])
-        if blob_length > config.file_download_limit_int:
-            pbar.bar_format = '%s{desc}Skipped (larger than %s)%s' % (
-                Fore.YELLOW, config.file_download_limit, Fore.RESET)
-            pbar.clear()
-            return
-
-        if blob_length < 1024 * 1024 * 1:  # 1 MB
-            res = http.download_small_file(url, file_path)
-        else:
-            res = http.download_large_file(url, file_path, pbar.update)
+        status, reason = get_file(file_node, local_folder, pbar.update)
 
-        if res.status_code == 200:
-            pbar.bar_format = '%s{desc}Downloaded%s' % (
-                Fore.GREEN, Fore.RESET)
-        else:
-            pbar.bar_format = '%s{desc}Failed when download. Reason:%s%s' % (
-                Fore.RED, res.reason, Fore.RESET)
+        pbar.bar_format = get_status_bar_format(status, reason, 'download')
         pbar.clear()
-        return res
+        return status
+
+
+class Downloader(Transfer):
+    """Mirrors remote folder tree into local folder.
+    Remote tree is listed breadth first and file nodes are queued to
+    a pool of download workers, so listing and transfer overlap.
+    The bounded queue holds the listing back when workers fall behind"""
+
+    def __init__(self, jobs=1):
+        super().__init__(jobs)
+        self.queue = queue.Queue(maxsize=self.jobs * 4)
+        http.transport.ensure_pool_size(self.jobs + config.page_prefetch + 1)
 
+    def run(self, folder_node, local_folder):
+        with tqdm(total=0, unit='B', unit_scale=True,
+                  desc='Downloading') as self.pbar:
+            workers = self.start_workers(self.work, self.queue, self.jobs)
+            try:
+                self.walk(folder_node, local_folder)
+            finally:
+                self.stop_workers(self.queue, workers)
 
-def download_folder(folder_node, local_folder=None):
+        self.raise_error()
+        print_transfer_summary(self.results)
+        return self.results
+
+    def walk(self, folder_node, local_folder):
+        folders = deque([(folder_node, path.abspath(local_folder))])
+        while folders and not self.error:
+            (folder_node, local_folder) = folders.popleft()
+            local_folder = path.join(local_folder, folder_node.get('name', ''))
+            Path(local_folder).mkdir(parents=True, exist_ok=True)
+
+            for remote_node in nodes.get_nodes(folder_node['id']) or []:
+                if self.error:
+                    return
+                if remote_node['type'] == 'Folder':
+                    folders.append((remote_node, local_folder))
+                    continue
+                with self.lock:
+                    self.files_count += 1
+                    if remote_node.get('blob'):
+                        self.pbar.total += int(remote_node['blob']['length'])
+                        self.pbar.refresh()
+                self.queue.put((remote_node, local_folder))
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error:
+                continue
+            (file_node, local_folder) = item
+            try:
+                status, reason = get_file(
+                    file_node, local_folder, self.update_progress)
+            except http.AuthorizationError:
+                raise
+            except Exception as err:
+                logger.debug(err, exc_info=True)
+                status, reason = FAILED, str(err)
+            self.add_result(
+                path.join(local_folder, file_node['name']), status, reason)
+
+
+def download_folder(folder_node, local_folder=None, jobs=1):
     if not folder_node:
         return
 
@@ -160,134 +566,538 @@ def download_folder(folder_node, local_folder=None):
         print('Node type is not a folder')
         return
 
-    local_folder = path.abspath(local_folder)
-    local_folder = path.join(local_folder, folder_node.get('name', ''))
-    Path(local_folder).mkdir(parents=True, exist_ok=True)
+    return Downloader(jobs).run(folder_node, local_folder or os.getcwd())
+
+
+def is_ignored(file_path):
+    """Tells whether sync leaves the file alone: sync metadata and
+    part files of unfinished downloads"""
+    return path.basename(file_path) in [LEGACY_SYNC_FILE, '.DS_Store'] or \
+        http.is_part_file(file_path)
 
-    remote_nodes = nodes.get_nodes(folder_node['id'])
-    for remote_node in remote_nodes:
-        if remote_node['type'] == 'Folder':
-            download_folder(remote_node, local_folder)
-        else:
-            download_file(remote_node, local_folder)
 
+def is_changed(entry, file_stat):
+    """Cheap check by size and modification time"""
+    if entry['size'] is None:
+        return entry['mtime'] < file_stat.st_mtime_ns // 1000 * 1000
+    return entry['size'] != file_stat.st_size or \
+        entry['mtime'] != file_stat.st_mtime_ns
 
-def sync_upload(local_directory, remote_folder_id, skip_files=False):
-    leanda_sync_path = path.join(local_directory, '.leanda-sync')
-    delimeter = ': '
-    timestamp_fmt = '%Y-%m-%d %H:%M:%S %f'
-    sync_dict = {}
-    if path.exists(leanda_sync_path):
-        with open(leanda_sync_path, 'r') as f:
-            for line in [line.rstrip('\n') for line in f]:
-                sync_dict[line.split(delimeter)[1]] = datetime.strptime(
-                    line.split(delimeter)[0], timestamp_fmt)
 
+def sync_upload(local_directory, remote_folder_id, skip_files=False,
+                state=None, recursive=True):
+    """Uploads new and changed files of the directory tree.
+    Files are hashed only when their size or modification time changed,
+    so touched files with the same content are not uploaded again and
+    a file renamed within its directory is renamed remotely.
+    Unless `recursive`, only new subdirectories are descended into"""
+    state = state or SyncState(local_directory)
+    sync_dict = state.children(local_directory)
+
+    folder_index = nodes.FolderIndex(remote_folder_id)
     for (dirpath, dirnames, filenames) in walk(local_directory):
         if not skip_files:
             for file_name in filenames:
-                if file_name in ['.leanda-sync', '.DS_Store']:
+                if is_ignored(file_name):
                     continue
                 file_path = path.join(local_directory, file_name)
-                modified_datetime = datetime.fromtimestamp(
-                    Path(file_path).stat().st_mtime)
-
-                if file_name not in sync_dict:
-                    sync_dict[file_name] = modified_datetime
-                    upload_file(file_path, remote_folder_id)
-
-                elif sync_dict[file_name] < modified_datetime:
-                    sync_dict[file_name] = modified_datetime
-                    # nodes.remove(file_name, remote_folder_id)
-                    upload_file(file_path, remote_folder_id)
+                sync_file(file_path, remote_folder_id, sync_dict,
+                          filenames, folder_index, state)
 
         for dir_name in dirnames:
+            if not recursive and dir_name in sync_dict:
+                continue
             dir_path = path.join(local_directory, dir_name)
-            modified_datetime = datetime.fromtimestamp(
-                Path(dir_path).stat().st_mtime)
+            modified = Path(dir_path).stat().st_mtime_ns
+            entry = sync_dict.get(dir_name)
+            folder_node_id = entry and entry['node_id'] or \
+                get_or_create_folder(dir_name, folder_index)
 
-            folder_node = nodes.get_first_folder_by_name(
-                dir_name, remote_folder_id)
-            folder_node_id = folder_node and folder_node['id'] or nodes.create_folder(
-                dir_name, remote_folder_id)
-
-            if dir_name not in sync_dict or sync_dict[dir_name] < modified_datetime:
-                sync_dict[dir_name] = modified_datetime
-                sync_upload(dir_path, folder_node_id)
+            if not entry or entry['mtime'] < modified:
+                sync_upload(dir_path, folder_node_id, state=state)
+                state.put(dir_path, modified, node_id=folder_node_id,
+                          is_dir=True)
             else:
-                sync_upload(dir_path, folder_node_id, True)
-
-        for key, value in list(sync_dict.items()):
-            if key not in [*filenames, *dirnames]:
-                del sync_dict[key]
-                nodes.remove(key, remote_folder_id)
+                if not entry['node_id']:
+                    state.put(dir_path, entry['mtime'],
+                              node_id=folder_node_id, is_dir=True)
+                # files of a directory with the same mtime were not added,
+                # removed or renamed, only its subdirectories are checked
+                sync_upload(dir_path, folder_node_id, True, state)
 
-        with open(leanda_sync_path, 'w') as f:
-            for key, value in sync_dict.items():
-                f.write(f'{value.strftime(timestamp_fmt)}{delimeter}{key}\n')
+        local_names = {*filenames, *dirnames}
+        removed_names = [key for key in sync_dict if key not in local_names]
+        if removed_names:
+            nodes.remove(removed_names, remote_folder_id)
+            for name in removed_names:
+                state.delete(path.join(local_directory, name))
         break
 
 
+def get_or_create_folder(folder_name, folder_index, folder_indexes=None):
+    """Returns id of the named remote folder, creates it if not found.
+    Created folder is registered in `folder_indexes` as empty"""
+    folder_nodes = [x for x in folder_index.get(folder_name)
+                    if x['type'] == 'Folder']
+    if folder_nodes:
+        return folder_nodes[0]['id']
+    folder_id = nodes.create_folder(folder_name, folder_index.remote_folder_id)
+    if folder_id:
+        folder_index.add({'id': folder_id, 'name': folder_name,
+                          'type': 'Folder'})
+        if folder_indexes:
+            folder_indexes.put(folder_id)
+    return folder_id
+
+
+def sync_file(file_path, remote_folder_id, sync_dict, local_names,
+              folder_index, state):
+    """Uploads the file unless its content is already synced.
+    Records synced file in `state`"""
+    file_name = path.basename(file_path)
+    file_stat = Path(file_path).stat()
+    entry = sync_dict.get(file_name)
+    if entry and not is_changed(entry, file_stat):
+        if entry['hash'] is None:
+            state.put(file_path, entry['mtime'], file_stat.st_size,
+                      util.get_file_hash(file_path), entry['node_id'])
+        return
+
+    file_hash = util.get_file_hash(file_path)
+    if entry and entry['hash'] == file_hash:
+        state.put(file_path, file_stat.st_mtime_ns, file_stat.st_size,
+                  file_hash, entry['node_id'])
+        return
+
+    if not entry:
+        node_id = rename_synced_file(
+            file_path, file_hash, remote_folder_id, sync_dict, local_names,
+            folder_index, state)
+        if node_id:
+            state.put(file_path, file_stat.st_mtime_ns, file_stat.st_size,
+                      file_hash, node_id)
+            return
+
+    if upload_file(file_path, remote_folder_id, folder_index) == UPLOADED:
+        state.put(file_path, file_stat.st_mtime_ns, file_stat.st_size,
+                  file_hash)
+
+
+def rename_synced_file(file_path, file_hash, remote_folder_id, sync_dict,
+                       local_names, folder_index, state):
+    """Renames remote node when a synced file with the same content
+    disappeared from the directory. Returns id of the renamed node"""
+    file_name = path.basename(file_path)
+    for (old_name, entry) in list(sync_dict.items()):
+        if entry['hash'] != file_hash or old_name in local_names:
+            continue
+        remote_nodes = folder_index.get(old_name)
+        if len(remote_nodes) != 1:
+            continue
+        res = nodes.rename(remote_nodes[0]['id'], file_name)
+        if res is None or res.status_code not in [200, 202, 204]:
+            continue
+        folder_index.discard(remote_nodes[0])
+        folder_index.add({**remote_nodes[0], 'name': file_name})
+        del sync_dict[old_name]
+        state.delete(path.join(path.dirname(file_path), old_name))
+        logger.info(f'Renamed "{old_name}" to "{file_name}"')
+        return remote_nodes[0]['id']
+    return None
+
+
 def sync(local_directory, remote_folder_node):
-    # watch_remote()
-    # while True:
-    #     time.sleep(1)
-    # return
     logger.info('Sync...')
-    sync_upload(local_directory, remote_folder_node['id'])
-    # return
-    # upload_files(list(local_files), id)
-    # upload_directories(local_folders, id)
-    # break
+    auth.keep_fresh()
+    state = SyncState(local_directory)
+    sync_upload(local_directory, remote_folder_node['id'], state=state)
 
+    worker = SyncWorker(local_directory, remote_folder_node['id'], state)
+    worker.request_remote_reconcile()
+    worker.start()
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1,
+                      lambda signum, frame: worker.request_reconcile())
+    hub_connection = watch_remote(worker)
     try:
-        observer = watch_local(
-            local_directory, remote_folder_node, lambda x, e: print(x, e))
+        observer = watch_local(local_directory, worker)
         while True:
             time.sleep(1)
     except KeyboardInterrupt:
         observer.stop()
     observer.join()
+    hub_connection.stop()
+    worker.stop()
+    worker.join()
+
+
+class SyncWorker(threading.Thread):
+    """Syncs local changes reported by the file system observer
+    and remote changes reported by the notification hub.
+
+    Changed paths and node ids are collected until no new change arrives
+    for `debounce` seconds, so a burst of events from one save is synced
+    once. Only directories containing changed paths and the nodes named
+    by remote events are synced; a full reconcile of the tree runs only
+    when requested.
+    """
+
+    def __init__(self, local_directory, remote_folder_id, state,
+                 debounce=None):
+        super().__init__(daemon=True)
+        self.local_directory = state.root
+        self.remote_folder_id = remote_folder_id
+        self.state = state
+        self.remote = RemoteSync(remote_folder_id, state)
+        self.debounce = config.sync_debounce if debounce is None else debounce
+        self.paths = set()
+        self.node_ids = set()
+        self.reconcile = False
+        self.remote_reconcile = False
+        self.stopped = False
+        self.last_change = 0
+        self.condition = threading.Condition()
+
+    def add(self, *local_paths):
+        with self.condition:
+            self.paths.update(local_paths)
+            self.last_change = time.monotonic()
+            self.condition.notify()
 
+    def add_remote(self, *node_ids):
+        with self.condition:
+            self.node_ids.update(node_ids)
+            self.last_change = time.monotonic()
+            self.condition.notify()
 
-class CustomEventHandler(events.FileSystemEventHandler):
-    fn: object
+    def request_reconcile(self):
+        with self.condition:
+            self.reconcile = True
+            self.condition.notify()
 
-    def __init__(self, local_directory, remote_folder_node, fn):
-        self.local_directory = local_directory
-        self.remote_folder_node = remote_folder_node
-        self.fn = fn
+    def request_remote_reconcile(self):
+        with self.condition:
+            self.remote_reconcile = True
+            self.condition.notify()
 
-    def on_any_event(self, event: events.FileSystemEvent):
-        if not event.src_path.endswith('.leanda-sync'):
-            sync_upload(self.local_directory, self.remote_folder_node['id'])
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
 
+    def has_changes(self):
+        return self.paths or self.node_ids or self.reconcile or \
+            self.remote_reconcile
 
-def watch_local(local_directory, remote_folder_node, fn):
-    handler = CustomEventHandler(local_directory, remote_folder_node, fn)
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(
+                    lambda: self.has_changes() or self.stopped)
+                while (self.paths or self.node_ids) and not self.stopped:
+                    wait = self.last_change + self.debounce - time.monotonic()
+                    if wait <= 0:
+                        break
+                    self.condition.wait(wait)
+                if self.stopped:
+                    return
+                (local_paths, node_ids) = (self.paths, self.node_ids)
+                (reconcile, remote_reconcile) = (
+                    self.reconcile, self.remote_reconcile)
+                (self.paths, self.node_ids) = (set(), set())
+                (self.reconcile, self.remote_reconcile) = (False, False)
+            try:
+                if reconcile:
+                    logger.info('Sync...')
+                    sync_upload(self.local_directory, self.remote_folder_id,
+                                state=self.state)
+                elif local_paths:
+                    self.sync_paths(local_paths)
+                if remote_reconcile:
+                    self.remote.reconcile()
+                elif node_ids:
+                    self.remote.apply(node_ids)
+            except Exception as err:
+                logger.error(f'Sync failed: {err}')
+
+    def sync_paths(self, local_paths):
+        directories = {self.get_synced_directory(x) for x in local_paths}
+        for directory in sorted(directories, key=len):
+            if not path.isdir(directory):
+                continue
+            entry = self.state.get(directory)
+            remote_folder_id = entry and entry['node_id'] or \
+                self.remote_folder_id
+            sync_upload(directory, remote_folder_id, state=self.state,
+                        recursive=False)
+
+    def get_synced_directory(self, local_path):
+        """Returns closest directory of the path known to the remote side"""
+        directory = path.dirname(local_path)
+        while directory.startswith(self.local_directory + os.sep):
+            entry = self.state.get(directory)
+            if entry and entry['node_id'] and path.isdir(directory):
+                return directory
+            directory = path.dirname(directory)
+        return self.local_directory
+
+
+class RemoteSync():
+    """Applies remote changes to the synced local directory.
+
+    Nodes are matched to local paths through the sync state. A local
+    file changed since it was last synced is never overwritten or
+    removed by a remote change; the conflict is logged and the local
+    version is uploaded by the next local sync instead.
+    """
+
+    def __init__(self, remote_folder_id, state):
+        self.remote_folder_id = remote_folder_id
+        self.state = state
+
+    def reconcile(self):
+        logger.info('Sync remote changes...')
+        self.sync_folder(self.remote_folder_id, self.state.root)
+
+    def apply(self, node_ids):
+        """Syncs the nodes named by remote events"""
+        for node_id in node_ids:
+            try:
+                node = self.get_node(node_id)
+            except IOError as err:
+                logger.error(f'Node with ID {{{node_id}}} not synced: {err}')
+                continue
+            if node is None:
+                self.remove_local(node_id)
+            elif node['type'] == 'File':
+                self.sync_file(node)
+            elif node['id'] == self.remote_folder_id:
+                self.sync_folder(node['id'], self.state.root, False)
+            else:
+                local_directory = self.sync_directory(node)
+                if local_directory:
+                    self.sync_folder(node['id'], local_directory, False)
+
+    def get_node(self, node_id):
+        """Returns current node or None if it was deleted"""
+        node_cache.invalidate(node_id)
+        res = http.get(f'{config.web_core_api_url}/nodes/{node_id}')
+        if res is None:
+            raise IOError('no response')
+        if res.status_code == 404:
+            return None
+        if res.status_code != 200:
+            raise IOError(res.reason)
+        node = res.json()
+        return None if node.get('isDeleted') else node
+
+    def get_local_directory(self, folder_id):
+        if folder_id == self.remote_folder_id:
+            return self.state.root
+        local_directory = self.state.find(folder_id)
+        return local_directory if local_directory and \
+            path.isdir(local_directory) else None
+
+    def sync_folder(self, folder_id, local_directory, recursive=True):
+        """Syncs children of the remote folder. Unless `recursive`,
+        only new subfolders are descended into"""
+        remote_nodes = list(nodes.get_nodes(folder_id, False))
+        for node in remote_nodes:
+            if node['type'] == 'File':
+                self.sync_file(node, local_directory)
+            elif node['type'] == 'Folder':
+                is_new = not self.state.find(node['id'])
+                sub_directory = self.sync_directory(node, local_directory)
+                if sub_directory and (recursive or is_new):
+                    self.sync_folder(node['id'], sub_directory, recursive)
+
+        node_ids = {node['id'] for node in remote_nodes}
+        for entry in self.state.children(local_directory).values():
+            if entry['node_id'] and entry['node_id'] not in node_ids:
+                self.remove_local(entry['node_id'])
+
+    def sync_directory(self, folder_node, parent_directory=None):
+        """Creates or renames local directory of the folder.
+        Returns its path or None if the folder is not synced"""
+        parent_directory = parent_directory or \
+            self.get_local_directory(folder_node['parentId'])
+        if not parent_directory:
+            return None
+        local_directory = path.join(parent_directory, folder_node['name'])
+        synced_directory = self.state.find(folder_node['id'])
+        if synced_directory and synced_directory != local_directory and \
+                path.isdir(synced_directory) and \
+                not path.exists(local_directory):
+            os.rename(synced_directory, local_directory)
+            self.state.move(synced_directory, local_directory)
+            logger.info(f'Moved "{synced_directory}" to "{local_directory}"')
+        if path.exists(local_directory) and not path.isdir(local_directory):
+            logger.warning(f'Conflict: "{local_directory}" is a file locally')
+            return None
+        os.makedirs(local_directory, exist_ok=True)
+        entry = self.state.get(local_directory)
+        if not entry or entry['node_id'] != folder_node['id']:
+            self.state.put(local_directory,
+                           Path(local_directory).stat().st_mtime_ns,
+                           node_id=folder_node['id'], is_dir=True)
+        return local_directory
+
+    def sync_file(self, file_node, local_directory=None):
+        """Downloads new or changed remote file unless the local one
+        was changed too"""
+        local_directory = local_directory or \
+            self.get_local_directory(file_node['parentId'])
+        if not local_directory:
+            return
+        file_path = path.join(local_directory, file_node['name'])
+        synced_path = self.state.find(file_node['id'])
+        if synced_path == file_path:
+            return
+        if synced_path and path.isfile(synced_path) and \
+                not path.exists(file_path) and \
+                not self.is_changed_locally(synced_path):
+            os.rename(synced_path, file_path)
+            self.state.move(synced_path, file_path)
+            logger.info(f'Moved "{synced_path}" to "{file_path}"')
+            return
+
+        entry = self.state.get(file_path)
+        if path.exists(file_path):
+            if self.is_changed_locally(file_path):
+                logger.warning(f'Conflict: "{file_path}" was changed '
+                               'locally and remotely, local changes kept')
+                return
+            if not entry['node_id'] and file_node['blob'] and \
+                    int(file_node['blob']['length']) == entry['size']:
+                # uploaded by this sync, the node id was not known yet
+                self.state.put(file_path, entry['mtime'], entry['size'],
+                               entry['hash'], file_node['id'])
+                return
+
+        (status, reason) = get_file(file_node, local_directory)
+        if status != DOWNLOADED:
+            logger.error(f'"{file_path}" not downloaded: {reason}')
+            return
+        file_stat = Path(file_path).stat()
+        self.state.put(file_path, file_stat.st_mtime_ns, file_stat.st_size,
+                       util.get_file_hash(file_path), file_node['id'])
+        logger.info(f'Downloaded "{file_path}"')
+
+    def remove_local(self, node_id):
+        """Removes local file or directory of the deleted remote node"""
+        local_path = self.state.find(node_id)
+        if not local_path:
+            return
+        changed = [x for x in self.walk_files(local_path)
+                   if self.is_changed_locally(x)]
+        self.state.delete(local_path)
+        if changed:
+            logger.warning(f'Conflict: "{local_path}" was removed remotely '
+                           'but changed locally, local changes kept')
+        elif path.isdir(local_path):
+            shutil.rmtree(local_path)
+            logger.info(f'Removed "{local_path}"')
+        elif path.exists(local_path):
+            os.remove(local_path)
+            logger.info(f'Removed "{local_path}"')
+
+    def is_changed_locally(self, file_path):
+        entry = self.state.get(file_path)
+        return not entry or is_changed(entry, Path(file_path).stat())
+
+    def walk_files(self, local_path):
+        if not path.isdir(local_path):
+            return path.isfile(local_path) and [local_path] or []
+        return [path.join(dirpath, file_name)
+                for (dirpath, dirnames, filenames) in walk(local_path)
+                for file_name in filenames
+                if not is_ignored(file_name)]
+
+
+class CustomEventHandler():
+    """Passes paths of changed files and directories to the sync worker.
+    Implements the `dispatch` method watchdog observers call, so watchdog
+    is imported only when a directory is watched"""
+
+    def __init__(self, worker):
+        self.worker = worker
+
+    def dispatch(self, event):
+        local_paths = [event.src_path, getattr(event, 'dest_path', None)]
+        local_paths = [path.realpath(x) for x in local_paths
+                       if x and not is_ignored(x)]
+        if local_paths:
+            self.worker.add(*local_paths)
+
+
+def watch_local(local_directory, worker):
+    from watchdog.observers import Observer
+
+    handler = CustomEventHandler(worker)
     observer = Observer()
     observer.schedule(handler, local_directory, recursive=True)
     observer.start()
     return observer
 
 
-def watch_remote():
-    hub_connection = HubConnectionBuilder() \
-        .with_url(config.web_socket_url,
-                  options={
-                      'access_token_factory': lambda: session.token.replace('bearer ', ''),
-                      'headers': {
-                          'Authorization': session.token
-                      }
-                  }).configure_logging(logging.ERROR).with_automatic_reconnect({
-                      'type': 'raw',
-                      'keep_alive_interval': 10,
-                      'reconnect_interval': 5,
-                      'max_attempts': 5
-                  }).build()
-
-    hub_connection.on_open(lambda: print("++++connection opened"))
-    hub_connection.on_close(lambda: print("++++connection closed"))
-    hub_connection.on("organizeUpdate", print)
-    hub_connection.on("updateNotficationBar", print)
-    hub_connection.start()
+def watch_remote(worker, retry_interval=30):
+    """Passes ids of nodes named by hub events to the sync worker.
+    Remote changes are reconciled after the connection is restored.
+    While the hub cannot be reached only local changes are synced,
+    the connection is retried every `retry_interval` seconds"""
+    hub_connection = hub.build_connection()
+    closed = threading.Event()
+
+    def on_open():
+        if closed.is_set():
+            closed.clear()
+            worker.request_remote_reconcile()
+
+    hub_connection.on_open(on_open)
+    hub_connection.on_close(closed.set)
+    if hasattr(hub_connection, 'on_reconnect'):
+        # signalrcore 0.8 has no reconnect event, a reconnect
+        # calls `on_open` after `on_close` there
+        hub_connection.on_reconnect(worker.request_remote_reconcile)
+    hub_connection.on('organizeUpdate',
+                      lambda args: worker.add_remote(*get_event_node_ids(args)))
+    if not start_hub(hub_connection):
+        logger.warning('Notification hub is not reachable, remote changes '
+                       'are synced once it is')
+        # reconciles remote changes missed meanwhile in `on_open`
+        closed.set()
+
+        def retry():
+            while not worker.stopped:
+                time.sleep(retry_interval)
+                if start_hub(hub_connection):
+                    logger.info('Notification hub connected')
+                    return
+
+        threading.Thread(target=retry, daemon=True).start()
+    return hub_connection
+
+
+def start_hub(hub_connection):
+    """Returns True if the hub connection started"""
+    try:
+        return hub_connection.start() is not False
+    except Exception as err:
+        logger.debug(err, exc_info=True)
+        return False
+
+
+def get_event_node_ids(message):
+    """Returns ids of nodes named by a hub event"""
+    if isinstance(message, list):
+        return {x for item in message for x in get_event_node_ids(item)}
+    if not isinstance(message, dict):
+        return set()
+    node_ids = set()
+    for key, value in message.items():
+        if isinstance(value, (dict, list)):
+            node_ids.update(get_event_node_ids(value))
+        elif key.lower() in ['id', 'nodeid', 'parentid'] and \
+                isinstance(value, str) and util.is_valid_uuid4(value):
+            node_ids.add(value)
+    return node_ids
@@ -1,52 +1,192 @@
-import click
 import json
 import logging
-import magic
 import mimetypes
-import requests
-import sys
+import os
+import threading
+import time
 
-from colorama import Fore
-from os import path, stat
-from requests_toolbelt import MultipartEncoder, MultipartEncoderMonitor
-from requests.exceptions import ChunkedEncodingError
-from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
+from os import path
 
+from leanda import util
 from leanda.config import config
-from leanda.session import session
-from leanda.util import truncate_string_middle
-from pprint import pprint
+
+# requests, requests_toolbelt and magic are imported on first use,
+# commands answered from the local cache or session never load them
 
 logger = logging.getLogger('blobs')
 
 
+RETRY_STATUSES = (500, 502, 503, 504)
+# methods safe to send again after a failure, the ones urllib3 retries
+IDEMPOTENT_METHODS = ('DELETE', 'GET', 'HEAD', 'OPTIONS', 'PUT', 'TRACE')
+
+# seconds spent in every upload stage since the last `reset_stats`
+upload_timings = {'scan': 0.0, 'prepare': 0.0, 'send': 0.0}
+
+
+class Transport():
+    """Process wide HTTP transport.
+
+    Keeps a pool of keep-alive connections per host (core API, blob API,
+    identity server) and retries failed requests with backoff.
+    """
+
+    def __init__(self, pool_size=None, retries=None, backoff_factor=None):
+        self.retries = config.http_retries if retries is None else retries
+        self.backoff_factor = config.http_backoff_factor \
+            if backoff_factor is None else backoff_factor
+        self.pool_size = pool_size or config.http_pool_size
+        self.retry = None
+        self.adapters = []
+        self.requests_count = 0
+        self.baseline = {}
+        self.lock = threading.Lock()
+        self.session = None
+
+    def connect(self):
+        """Creates the requests session on first use"""
+        with self.lock:
+            if self.session is None:
+                import requests
+                from urllib3.util.retry import Retry
+
+                self.retry = Retry(
+                    total=self.retries, backoff_factor=self.backoff_factor,
+                    status_forcelist=RETRY_STATUSES, raise_on_status=False)
+                self.session = requests.Session()
+                self.mount(self.pool_size)
+        return self.session
+
+    def mount(self, pool_size):
+        from requests.adapters import HTTPAdapter
+
+        self.pool_size = pool_size
+        adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size,
+            max_retries=self.retry)
+        self.adapters.append(adapter)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def ensure_pool_size(self, pool_size):
+        """Grows connection pools to serve `pool_size` concurrent workers"""
+        if pool_size > self.pool_size:
+            if self.session is None:
+                self.pool_size = pool_size
+            else:
+                self.mount(pool_size)
+
+    def request(self, method, url, **kwargs):
+        session = self.connect()
+        with self.lock:
+            self.requests_count += 1
+        return session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs): return self.request('get', url, **kwargs)
+
+    def post(self, url, **kwargs): return self.request('post', url, **kwargs)
+
+    def patch(self, url, **kwargs): return self.request('patch', url, **kwargs)
+
+    def counters(self):
+        """Returns process wide request and connection counters"""
+        opened = requested = 0
+        for adapter in self.adapters:
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools[key]
+                opened += pool.num_connections
+                requested += pool.num_requests
+        return {'requests': self.requests_count,
+                'opened': opened, 'requested': requested}
+
+    def stats(self):
+        """Returns number of requests sent and connections opened and
+        reused since the last `reset_stats`"""
+        counters = {key: max(value - self.baseline.get(key, 0), 0)
+                    for (key, value) in self.counters().items()}
+        return {'requests': counters['requests'],
+                'opened': counters['opened'],
+                'reused': max(counters['requested'] - counters['opened'], 0)}
+
+    def reset_stats(self):
+        self.baseline = self.counters()
+
+
+transport = Transport()
+
+
+def reset_stats():
+    """Starts counting requests, connections and upload stage timings
+    anew, e.g. for every command served by the daemon"""
+    transport.reset_stats()
+    for stage in upload_timings:
+        upload_timings[stage] = 0.0
+
+
+class AuthorizationError(Exception):
+    """Session is not authorized and cannot be refreshed"""
+
+
+class RequestError(IOError):
+    """Request failed after all retries"""
+
+
 def exit_by_unauthorized_reason(res):
     if res.status_code == 401:
         logger.error('Please login and retry!')
 
 
+def send(method, url, headers=None, **kwargs):
+    """Sends the request with the access token of the session, refreshed
+    shortly before it expires. A request answered with 401 is sent once
+    more after refreshing the token. Raises AuthorizationError if the
+    session cannot be refreshed"""
+    from leanda.api import auth
+
+    for retry in (False, True):
+        token = auth.get_token()
+        res = transport.request(
+            method, url, headers={**(headers or {}), 'Authorization': token},
+            **kwargs)
+        if res.status_code != 401 or retry:
+            break
+        res.close()
+        if not auth.refresh(token):
+            break
+    if res.status_code == 401:
+        login_and_retry()
+    return res
+
+
 def fetch(method, url, data=None, headers=None):
     base_headers = {
         'Accept': '*/*',
         'Content-Type': 'application/json',
-        'Authorization': session.token
     }
     if headers:
         base_headers.update(headers)
 
     if isinstance(data, dict):
         data = json.dumps(data)
-    try:
-        res = getattr(requests, method)(
-            url=url, headers=base_headers, data=data)
-        if res.status_code == 401:
-            login_and_retry()
-        return res
-    except ChunkedEncodingError as error:
-        login_and_retry()
+    # a broken response body means the server already applied
+    # the request, only idempotent requests are sent again
+    retries = config.http_retries \
+        if method.upper() in IDEMPOTENT_METHODS else 0
+    last_error = None
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(config.http_backoff_factor * 2 ** attempt)
+        try:
+            return send(method, url, headers=base_headers, data=data)
+        except get_transfer_errors()[0] as error:
+            logger.debug(error, exc_info=True)
+            last_error = error
+    raise RequestError(f'Request failed: {last_error}')
 
 
-def get(url): return fetch('get', url)
+def get(url, headers=None): return fetch('get', url, headers=headers)
 
 
 def post(url, data): return fetch(
@@ -58,91 +198,304 @@ def patch(url, data): return fetch(
 
 
 def get_mime_type(file_path):
-    return mimetypes.guess_type(file_path)[0] or magic.from_file(file_path, mime=True)
+    mime_type = mimetypes.guess_type(file_path)[0]
+    if not mime_type:
+        import magic
+        mime_type = magic.from_file(file_path, mime=True)
+    return mime_type
+
+
+def get_transfer_errors():
+    """Returns errors of interrupted transfers, ChunkedEncodingError first"""
+    from requests.exceptions import ChunkedEncodingError, ConnectionError, \
+        Timeout
+    from urllib3.exceptions import ProtocolError, ReadTimeoutError
+
+    return (ChunkedEncodingError, ConnectionError, Timeout,
+            ProtocolError, ReadTimeoutError)
+
+
+class UploadError(IOError):
+    pass
+
+
+class PartReader():
+    """File-like view of a multipart encoder read in fixed-size parts,
+    so no more than one part of the file is held in memory"""
+
+    def __init__(self, encoder, part_size):
+        self.encoder = encoder
+        self.part_size = part_size
+        self.len = encoder.len
 
+    def read(self, size=-1):
+        return self.encoder.read(self.part_size)
+
+
+def upload_large_file(url, file_path, data, chunk_callback=None,
+                      mime_type=None):
+    """Streams the file from disk in `config.upload_part_size` parts.
+    The upload is retried from the start of the file with backoff
+    when the connection fails or the server answers with 5xx"""
+    from requests_toolbelt import MultipartEncoder, MultipartEncoderMonitor
+    from leanda.api import auth
 
-def upload_large_file(url, file_path, data, chunk_callback=None):
     if not path.isfile(file_path):
         print(f'File {file_path} not found')
         return
-    file = open(file_path, 'rb')
     base_name = path.basename(file_path)
-    data.update({'file': (base_name, file, get_mime_type(file_path))})
-    encoder = MultipartEncoder(data)
+    mime_type = mime_type or get_mime_type(file_path)
+
+    last_error = None
+    attempt = 0
+    refreshed = False
+    while attempt <= config.http_retries:
+        if attempt:
+            time.sleep(config.http_backoff_factor * 2 ** attempt)
+        prev_bytes_read = 0
+        token = auth.get_token()
+        unauthorized = False
 
-    prev_bytes_read = 0
+        def progress_callback(x):
+            nonlocal prev_bytes_read
+            if chunk_callback:
+                chunk_callback(x.bytes_read-prev_bytes_read)
+            prev_bytes_read = x.bytes_read
 
-    def progress_callback(x):
-        nonlocal prev_bytes_read
+        with open(file_path, 'rb') as file:
+            encoder = MultipartEncoder(
+                {**data, 'file': (base_name, file, mime_type)})
+            monitor = MultipartEncoderMonitor(encoder, progress_callback)
+            headers = {
+                'Content-Type': monitor.content_type,
+                'Authorization': token
+            }
+            try:
+                with transport.post(
+                        url, data=PartReader(monitor, config.upload_part_size),
+                        headers=headers, stream=True) as res:
+                    unauthorized = res.status_code == 401
+                    if not unauthorized and \
+                            res.status_code not in RETRY_STATUSES:
+                        return res
+                    last_error = res.reason
+            except get_transfer_errors() as error:
+                logger.debug(error, exc_info=True)
+                last_error = error
         if chunk_callback:
-            chunk_callback(x.bytes_read-prev_bytes_read)
-        prev_bytes_read = x.bytes_read
-    monitor = MultipartEncoderMonitor(encoder, progress_callback)
-    headers = {
-        'Content-Type': monitor.content_type,
-        'Authorization': session.token
-    }
-    with requests.post(url, data=monitor, headers=headers, stream=True) as res:
-        if res.status_code == 401:
-            login_and_retry()
-        return res
+            chunk_callback(-prev_bytes_read)
+        if unauthorized:
+            # the file is sent again right away with a refreshed token
+            if refreshed or not auth.refresh(token):
+                login_and_retry()
+            refreshed = True
+            continue
+        attempt += 1
 
+    raise UploadError(f'Upload failed: {last_error}')
 
-def upload_small_file(url, file_path, data):
-    if not path.isfile(file_path):
-        print(f'File {file_path} not found')
-        return
 
-    encoded_data = MultipartEncoder(
-        fields={
-            **data,
-            'file': (path.basename(file_path),
-                     open(file_path, 'rb'), get_mime_type(file_path)),
-        }
-    )
+def encode_small_file(file_path, data, mime_type=None):
+    """Reads the file into a multipart body.
+    Returns (body, content type) tuple"""
+    from requests_toolbelt import MultipartEncoder
+
+    with open(file_path, 'rb') as file:
+        encoded_data = MultipartEncoder(
+            fields={
+                **data,
+                'file': (path.basename(file_path),
+                         file, mime_type or get_mime_type(file_path)),
+            }
+        )
+        return encoded_data.to_string(), encoded_data.content_type
+
+
+def upload_small_file(url, file_path, data, encoded=None):
+    """Sends the file in one request. `encoded` is the body
+    returned by `encode_small_file` if it was read in advance"""
+    if encoded is None:
+        if not path.isfile(file_path):
+            print(f'File {file_path} not found')
+            return
+        encoded = encode_small_file(file_path, data)
+
+    (body, content_type) = encoded
     headers = {
         'Accept': '*/*',
-        'Content-Type': encoded_data.content_type,
-        'Authorization': session.token
+        'Content-Type': content_type,
     }
-    res = requests.post(url, headers=headers, data=encoded_data)
-    if res.status_code == 401:
-        login_and_retry()
-    return res
+    return send('post', url, headers=headers, data=body)
 
 
-def download_large_file(url, file_path, chunk_callback=None):
-    headers = {
-        'Authorization': session.token,
-        'Content-Disposition': 'attachment'
-    }
-    with requests.get(url, headers=headers, stream=True) as res:
-        with open(file_path, 'wb') as f:
-            for chunk in res.iter_content(chunk_size=8192):
-                if chunk:
-                    f.write(chunk)
-                    if chunk_callback:
-                        chunk_callback(len(chunk))
-        if res.status_code == 401:
-            login_and_retry()
-        return res
+class DownloadError(IOError):
+    pass
 
 
-def download_small_file(url, file_path):
-    headers = {
-        'Authorization': session.token,
-        'Content-Disposition': 'attachment'
-    }
-    res = requests.get(url, headers=headers)
-    if res.status_code == 401:
-        login_and_retry()
+buffers = threading.local()
+
+
+def write_response(res, file, chunk_callback=None):
+    """Streams response body into the file through a reusable
+    per-thread buffer. Returns number of bytes written"""
+    buffer = getattr(buffers, 'buffer', None)
+    if buffer is None or len(buffer) != config.download_chunk_size:
+        buffer = buffers.buffer = bytearray(config.download_chunk_size)
+    view = memoryview(buffer)
+    res.raw.decode_content = True
+    written = 0
+    while True:
+        size = res.raw.readinto(view)
+        if not size:
+            return written
+        file.write(view[:size])
+        written += size
+        if chunk_callback:
+            chunk_callback(size)
+
+
+def get_part_path(file_path, blob_id=None):
+    """Returns path of the part file the blob is downloaded to.
+    Keyed by the blob id, so a part file left by another version
+    of the file is never resumed"""
+    return f'{file_path}.{blob_id}.part' if blob_id else f'{file_path}.part'
 
-    with open(file_path, 'wb') as f:
-        f.write(res.content)
 
+def is_part_file(file_path):
+    """Tells whether the file is a part file of an unfinished download"""
+    (stem, extension) = path.splitext(path.basename(file_path))
+    if extension != '.part':
+        return False
+    key = path.splitext(stem)[1][1:]
+    return key == 'segments' or util.is_valid_uuid4(key)
+
+
+def download_file(url, file_path, chunk_callback=None, length=None,
+                  blob_id=None):
+    """Streams the blob into its part file, resuming from its last byte
+    with a Range request after an interrupted transfer or a previous run.
+    The response status is checked before anything is written and
+    the part file is renamed into place once `length` bytes are written"""
+    part_path = get_part_path(file_path, blob_id)
+    offset = path.getsize(part_path) if path.isfile(part_path) else 0
+    if length is not None and offset > length:
+        offset = 0
+    if offset and chunk_callback:
+        chunk_callback(offset)
+    if length is not None and offset == length and path.isfile(part_path):
+        os.replace(part_path, file_path)
+        return None
+
+    last_error = None
+    for attempt in range(config.http_retries + 1):
+        if attempt:
+            time.sleep(config.http_backoff_factor * 2 ** attempt)
+        headers = {
+            'Content-Disposition': 'attachment'
+        }
+        if offset:
+            headers['Range'] = f'bytes={offset}-'
+        try:
+            with send('get', url, headers=headers, stream=True) as res:
+                if res.status_code not in [200, 206]:
+                    return res
+                if res.status_code == 200 and offset:
+                    if chunk_callback:
+                        chunk_callback(-offset)
+                    offset = 0
+                with open(part_path, 'ab' if offset else 'wb') as f:
+                    try:
+                        write_response(res, f, chunk_callback)
+                    finally:
+                        # counts bytes written before the connection dropped
+                        offset = f.tell()
+            if length is None or offset >= length:
+                break
+            last_error = f'received {offset} of {length} bytes'
+        except get_transfer_errors() as error:
+            logger.debug(error, exc_info=True)
+            last_error = error
+    else:
+        raise DownloadError(f'Download interrupted: {last_error}')
+
+    size = path.getsize(part_path)
+    if length is not None and size != length:
+        raise DownloadError(f'Downloaded {size} of {length} bytes')
+    os.replace(part_path, file_path)
     return res
 
 
+def download_segmented(url, file_path, length, segments, chunk_callback=None,
+                       blob_id=None):
+    """Fetches `segments` byte ranges of the blob in parallel into
+    a preallocated `file_path`.segments.part and renames it into place.
+    A failed segment is retried from its last written byte, the part
+    file is removed when the download fails: being zero-filled, it is
+    never resumed, unlike the `download_file` part file.
+    Falls back to `download_file` when ranges are not supported"""
+    part_path = f'{file_path}.segments.part'
+    with open(part_path, 'wb') as f:
+        f.truncate(length)
+
+    lock = threading.Lock()
+
+    def progress_callback(size):
+        if chunk_callback:
+            with lock:
+                chunk_callback(size)
+
+    def fetch_segment(start, end):
+        position = start
+        last_error = None
+        for attempt in range(config.http_retries + 1):
+            if attempt:
+                time.sleep(config.http_backoff_factor * 2 ** attempt)
+            headers = {
+                'Content-Disposition': 'attachment',
+                'Range': f'bytes={position}-{end}'
+            }
+            try:
+                with send('get', url, headers=headers, stream=True) as res:
+                    if res.status_code != 206:
+                        return res
+                    with open(part_path, 'r+b') as f:
+                        f.seek(position)
+                        try:
+                            write_response(res, f, progress_callback)
+                        finally:
+                            position = f.tell()
+                if position > end:
+                    return res
+                last_error = f'received {position - start} of {end - start + 1} bytes'
+            except get_transfer_errors() as error:
+                logger.debug(error, exc_info=True)
+                last_error = error
+        raise DownloadError(f'Download interrupted: {last_error}')
+
+    segment_size = -(-length // segments)
+    ranges = [(start, min(start + segment_size, length) - 1)
+              for start in range(0, length, segment_size)]
+    transport.ensure_pool_size(len(ranges) + 1)
+    try:
+        with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+            responses = list(
+                executor.map(lambda x: fetch_segment(*x), ranges))
+    except BaseException:
+        os.remove(part_path)
+        raise
+
+    failed_responses = [x for x in responses if x.status_code != 206]
+    if failed_responses:
+        os.remove(part_path)
+        if failed_responses[0].status_code != 200:
+            return failed_responses[0]
+        progress_callback(-sum(end - start + 1 for (start, end), res
+                               in zip(ranges, responses)
+                               if res.status_code == 206))
+        return download_file(url, file_path, chunk_callback, length, blob_id)
+    os.replace(part_path, file_path)
+    return responses[0]
+
+
 def login_and_retry():
-    logger.error('Please login and retry!')
-    sys.exit()
+    raise AuthorizationError('Please login and retry!')
@@ -0,0 +1,94 @@
+import json
+import logging
+import threading
+
+from os import path
+from urllib.parse import urlparse
+
+from leanda.config import config
+
+logger = logging.getLogger('hub')
+
+
+def build_connection(url=None):
+    """Returns connection to the notification hub.
+    A `file://` url starts a LocalHub reading events from the file"""
+    url = url or config.web_socket_url
+    if urlparse(url).scheme == 'file':
+        return LocalHub(urlparse(url).path)
+
+    from signalrcore.hub_connection_builder import HubConnectionBuilder
+    from leanda.api import auth
+
+    return HubConnectionBuilder() \
+        .with_url(url,
+                  options={
+                      'access_token_factory': lambda: auth.get_token().replace('bearer ', ''),
+                      'headers': {
+                          'Authorization': auth.get_token()
+                      }
+                  }).configure_logging(logging.ERROR).with_automatic_reconnect({
+                      'type': 'raw',
+                      'keep_alive_interval': 10,
+                      'reconnect_interval': 5,
+                      'max_attempts': 5
+                  }).build()
+
+
+class LocalHub():
+    """Stand-in for the SignalR hub connection used for testing.
+
+    Reads events appended to a JSON lines file, one
+    `{"event": "organizeUpdate", "args": [...]}` object per line.
+    `{"event": "close"}` and `{"event": "open"}` lines simulate
+    a dropped and a restored connection.
+    """
+
+    def __init__(self, events_path, interval=0.2):
+        self.events_path = events_path
+        self.interval = interval
+        self.handlers = {}
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.poll, daemon=True)
+
+    def on(self, event, callback):
+        self.handlers.setdefault(event, []).append(callback)
+
+    def on_open(self, callback):
+        self.on('open', lambda args: callback())
+
+    def on_close(self, callback):
+        self.on('close', lambda args: callback())
+
+    def on_reconnect(self, callback):
+        self.on('reconnect', lambda args: callback())
+
+    def emit(self, event, args=None):
+        for callback in self.handlers.get(event, []):
+            callback(args or [])
+
+    def start(self):
+        self.thread.start()
+        return True
+
+    def stop(self):
+        self.stopped.set()
+
+    def poll(self):
+        offset = path.getsize(self.events_path) \
+            if path.exists(self.events_path) else 0
+        self.emit('open')
+        while not self.stopped.wait(self.interval):
+            if not path.exists(self.events_path):
+                continue
+            with open(self.events_path, 'r') as f:
+                f.seek(offset)
+                lines = f.readlines()
+                if lines and not lines[-1].endswith('\n'):
+                    lines.pop()
+                offset += sum(len(line.encode()) for line in lines)
+            for line in lines:
+                if not line.strip():
+                    continue
+                message = json.loads(line)
+                self.emit(message['event'], message.get('args'))
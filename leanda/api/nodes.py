@@ -1,36 +1,73 @@
+import itertools
 import json
 import logging
+import threading
 import uuid
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import unquote
 
 from leanda import util
 from leanda.api import http
+from leanda.cache import node_cache
 from leanda.config import config
 from leanda.session import session
 
 logger = logging.getLogger('nodes')
 
 
-def get_node_by_id(node_id):
+def fetch_node(node_id):
+    """Returns (node, breadcrumbs) tuple read from a single response.
+    Uses the node cache, stale entries are revalidated with
+    a conditional request"""
+    cached = node_cache.get_node(node_id)
+    if cached and cached['fresh']:
+        return cached['node'], cached['breadcrumbs']
+
+    headers = {}
+    if cached and cached['etag']:
+        headers['If-None-Match'] = cached['etag']
+    if cached and cached['last_modified']:
+        headers['If-Modified-Since'] = cached['last_modified']
+
     url = f'{config.web_core_api_url}/nodes/{node_id}'
-    res = http.get(url)
-    if res.status_code == 200:
-        return res.json()
-    else:
+    res = http.get(url, headers=headers)
+    if res.status_code == 304 and cached:
+        node_cache.touch_node(node_id)
+        return cached['node'], cached['breadcrumbs']
+    if res.status_code != 200:
+        node_cache.invalidate(node_id)
         logger.error('Node with ID {%s} not found' % node_id)
+        return None, None
+
+    node = res.json()
+    breadcrumbs = json.loads(res.headers.get('X-Breadcrumbs') or '[]')
+    node_cache.put_node(node_id, node, breadcrumbs,
+                        res.headers.get('ETag'),
+                        res.headers.get('Last-Modified'))
+    node_cache.put_child_ids(get_breadcrumbs_child_ids(node, breadcrumbs))
+    return node, breadcrumbs
+
+
+def get_breadcrumbs_child_ids(node, breadcrumbs):
+    """Returns (parent id, name, child id) mappings of the node
+    and its ancestors"""
+    chain = [(node['id'], node.get('name'))]
+    chain.extend((x.get('Id'), x.get('Name')) for x in breadcrumbs)
+    return [(parent[0], child[1], child[0])
+            for (child, parent) in zip(chain, chain[1:]) if child[1]]
+
+
+def get_node_by_id(node_id):
+    return fetch_node(node_id)[0]
 
 
 def get_node_breadcrumbs(node_id):
-    url = f'{config.web_core_api_url}/nodes/{node_id}'
-    res = http.get(url)
-    if res.status_code == 200:
-        return json.loads(res.headers['X-Breadcrumbs'])
-    else:
-        logger.error('Node with ID {%s} not found' % node_id)
+    return fetch_node(node_id)[1]
 
 
-def get_nodes_by_id_or_name(node_id_or_name, remote_folder_id=session.cwd):
+def get_nodes_by_id_or_name(node_id_or_name, remote_folder_id=None):
     if util.is_valid_uuid4(node_id_or_name):
         return [get_node_by_id(node_id_or_name)]
     else:
@@ -44,21 +81,62 @@ def get_nodes_by_id_or_name(node_id_or_name, remote_folder_id=session.cwd):
 #     return http.get(url).json()
 
 
-def get_nodes(remote_folder_id=session.cwd):
-    url = f'{config.web_core_api_url}/nodes/{remote_folder_id}/nodes?pageSize=100&pageNumber=1'
-    res = http.get(url)
+def get_nodes(remote_folder_id=None, use_cache=True, page_size=None,
+              prefetch=None):
+    """Yields child nodes of the folder in listing order.
+    Pages after the first one are fetched concurrently, at most
+    `prefetch` pages in flight. Complete listings are stored in the
+    node cache, `use_cache=False` forces a fresh listing"""
+    remote_folder_id = remote_folder_id or session.cwd
+    page_size = page_size or config.page_size
+    prefetch = prefetch or config.page_prefetch
+
+    cached_nodes = use_cache and node_cache.get_listing(remote_folder_id)
+    if cached_nodes:
+        yield from cached_nodes
+        return
+
+    url = f'{config.web_core_api_url}/nodes/{remote_folder_id}/nodes?pageSize={page_size}&pageNumber=%s'
+    res = http.get(url % 1)
     if res.status_code != 200:
         logger.error("Couldn't get nodes")
         return
     pages = json.loads(res.headers['X-Pagination'])
-    yield from res.json()
-    while pages['nextPageLink']:
-        res = http.get(pages['nextPageLink'].replace(
-            'http://api.leanda.io/api', config.web_core_api_url))
-        if 'X-Pagination' not in res.headers:
-            break
-        pages = json.loads(res.headers['X-Pagination'])
-        yield from res.json()
+    listing = res.json()
+    yield from listing
+
+    if 'totalPages' not in pages:
+        while pages['nextPageLink']:
+            res = http.get(pages['nextPageLink'].replace(
+                'http://api.leanda.io/api', config.web_core_api_url))
+            if 'X-Pagination' not in res.headers:
+                return
+            pages = json.loads(res.headers['X-Pagination'])
+            listing.extend(res.json())
+            yield from res.json()
+        node_cache.put_listing(remote_folder_id, listing)
+        return
+
+    page_numbers = iter(range(2, int(pages['totalPages']) + 1))
+    executor = ThreadPoolExecutor(max_workers=prefetch)
+    in_flight = deque(executor.submit(http.get, url % x)
+                      for x in itertools.islice(page_numbers, prefetch))
+    try:
+        while in_flight:
+            res = in_flight.popleft().result()
+            page_number = next(page_numbers, None)
+            if page_number:
+                in_flight.append(executor.submit(http.get, url % page_number))
+            if res.status_code != 200:
+                logger.error("Couldn't get nodes")
+                return
+            listing.extend(res.json())
+            yield from res.json()
+        node_cache.put_listing(remote_folder_id, listing)
+    finally:
+        for future in in_flight:
+            future.cancel()
+        executor.shutdown(wait=False)
 
 
 def get_all_folders(remote_folder_id=None):
@@ -73,6 +151,14 @@ def get_all_files(remote_folder_id=None):
             yield item
 
 
+def get_first_node_by_name(name, remote_folder_id=None):
+    """returns the first found node with exact name,
+    remaining pages of the listing are not requested"""
+    for item in get_nodes(remote_folder_id):
+        if item['name'] == name:
+            return item
+
+
 def get_first_folder_by_name(name, remote_folder_id=None):
     """returns the first found folder with exact name"""
     for item in get_all_folders(remote_folder_id):
@@ -87,6 +173,70 @@ def get_first_file_by_name(name, remote_folder_id=None):
             return item
 
 
+class FolderIndex():
+    """Name to nodes index of a remote folder built from a single listing.
+    Keep it up to date with `add` and `discard` while changing the folder"""
+
+    def __init__(self, remote_folder_id=None, nodes=None):
+        self.remote_folder_id = remote_folder_id or session.cwd
+        self.nodes_by_name = None
+        self.lock = threading.Lock()
+        if nodes is not None:
+            self.nodes_by_name = {}
+            for node in nodes:
+                self.nodes_by_name.setdefault(node['name'], []).append(node)
+
+    def load(self):
+        with self.lock:
+            if self.nodes_by_name is None:
+                nodes_by_name = {}
+                for node in get_nodes(self.remote_folder_id, False):
+                    nodes_by_name.setdefault(node['name'], []).append(node)
+                self.nodes_by_name = nodes_by_name
+            return self.nodes_by_name
+
+    def get(self, name):
+        nodes_by_name = self.load()
+        with self.lock:
+            return list(nodes_by_name.get(name, []))
+
+    def add(self, node):
+        nodes_by_name = self.load()
+        with self.lock:
+            nodes_by_name.setdefault(node['name'], []).append(node)
+
+    def discard(self, node):
+        nodes_by_name = self.load()
+        with self.lock:
+            same_name_nodes = nodes_by_name.get(node['name'], [])
+            same_name_nodes[:] = [
+                x for x in same_name_nodes if x['id'] != node['id']]
+            if not same_name_nodes:
+                nodes_by_name.pop(node['name'], None)
+
+
+class FolderIndexes():
+    """Folder indexes shared by a batch of operations, one per folder"""
+
+    def __init__(self):
+        self.indexes = {}
+        self.lock = threading.Lock()
+
+    def get(self, remote_folder_id):
+        with self.lock:
+            if remote_folder_id not in self.indexes:
+                self.indexes[remote_folder_id] = FolderIndex(remote_folder_id)
+            return self.indexes[remote_folder_id]
+
+    def put(self, remote_folder_id, nodes=()):
+        """Registers index of a folder with known content,
+        e.g. an empty one just created, so it is not listed"""
+        with self.lock:
+            self.indexes[remote_folder_id] = FolderIndex(
+                remote_folder_id, nodes)
+            return self.indexes[remote_folder_id]
+
+
 def rename(node_id, new_name):
     if not new_name:
         logger.error('New name required when rename')
@@ -99,30 +249,83 @@ def rename(node_id, new_name):
         logger.error('Node has not version')
         return
 
-    url = f'{config.web_core_api_url}/entities/folders/{node_id}?version={node["version"]}'
+    entities = 'files' if node['type'] == 'File' else 'folders'
+    url = f'{config.web_core_api_url}/entities/{entities}/{node_id}?version={node["version"]}'
     data = [{"op": "replace", "path": "/name", "value": new_name}]
-    http.patch(url, json.dumps(data))
-
-
-def remove(node_name_or_id, remote_folder_id=session.cwd):
-    cwd_nodes = get_nodes_by_id_or_name(node_name_or_id, remote_folder_id)
-    if not len(cwd_nodes):
+    res = http.patch(url, json.dumps(data))
+    node_cache.invalidate(node_id)
+    node_cache.invalidate_listing(node.get('parentId'))
+    return res
+
+
+def remove(node_names_or_ids, remote_folder_id=None):
+    """Removes nodes by names in remote folder or by ids.
+    Accepts one name or id or a list of them"""
+    if isinstance(node_names_or_ids, str):
+        node_names_or_ids = [node_names_or_ids]
+    folder_index = FolderIndex(remote_folder_id)
+    found_nodes = []
+    for node_name_or_id in node_names_or_ids:
+        if util.is_valid_uuid4(node_name_or_id):
+            found_nodes.append(get_node_by_id(node_name_or_id))
+        else:
+            found_nodes.extend(folder_index.get(node_name_or_id))
+    found_nodes = list(filter(lambda x: x, found_nodes))
+    if not len(found_nodes):
         print('No nodes to remove')
         return
-    for node in cwd_nodes:
-        data = '''
-                [{"value": [{"id": "%s", "type": "File"}],
-                    "path": "/deleted",
-                    "op": "add",
-                }]
-                ''' % node['id']
-        url = f'{config.web_core_api_url}/nodecollections'
-        res = http.patch(url, data=data)
-        if res.status_code == 202:
-            logger.info('Node "%s" {%s} was removed!' % (
-                node['name'], node['id']))
-        else:
-            logger.error('Couldn\'t remove node {%s}' % node['id'])
+    return remove_nodes(found_nodes, folder_index.remote_folder_id)
+
+
+def remove_nodes(nodes_to_remove, remote_folder_id=None, batch_size=None):
+    """Removes nodes with one PATCH request per `batch_size` nodes.
+    Returns list of (node, removed) tuples"""
+    batch_size = batch_size or config.remove_batch_size
+    url = f'{config.web_core_api_url}/nodecollections'
+    results = []
+    for i in range(0, len(nodes_to_remove), batch_size):
+        batch = nodes_to_remove[i:i + batch_size]
+        data = [{'value': [{'id': x['id'], 'type': x.get('type') or 'File'}
+                           for x in batch],
+                 'path': '/deleted',
+                 'op': 'add'}]
+        res = http.patch(url, data=json.dumps(data))
+        removed = res.status_code == 202
+        for node in batch:
+            results.append((node, removed))
+            if removed:
+                node_cache.invalidate(node['id'])
+                node_cache.invalidate_listing(
+                    node.get('parentId') or remote_folder_id)
+                logger.info('Node "%s" {%s} was removed!' % (
+                    node['name'], node['id']))
+            else:
+                logger.error('Couldn\'t remove node {%s}' % node['id'])
+    return results
+
+
+class BatchRemover():
+    """Collects nodes to remove and removes them in batches"""
+
+    def __init__(self, batch_size=None):
+        self.batch_size = batch_size or config.remove_batch_size
+        self.nodes = []
+        self.results = []
+        self.lock = threading.Lock()
+
+    def add(self, nodes_to_remove):
+        with self.lock:
+            self.nodes.extend(nodes_to_remove)
+            if len(self.nodes) < self.batch_size:
+                return
+            batch, self.nodes = self.nodes, []
+        self.results.extend(remove_nodes(batch, batch_size=self.batch_size))
+
+    def flush(self):
+        with self.lock:
+            batch, self.nodes = self.nodes, []
+        self.results.extend(remove_nodes(batch, batch_size=self.batch_size))
+        return self.results
 
 
 def create_folder(name, remote_folder_id=None):
@@ -131,6 +334,7 @@ def create_folder(name, remote_folder_id=None):
     res = http.post(url=url, data=data)
 
     if res.status_code == 202:
+        node_cache.invalidate_listing(data['ParentId'])
         id = res.headers["Location"][-36:]
         logger.info(f'Folder "{name}" {{{id}}} successfully created')
         return id
@@ -138,20 +342,25 @@ def create_folder(name, remote_folder_id=None):
         logger.error('Cannot create remote folder')
 
 
-def create_location_if_not_exists(location, remote_folder_id=session.cwd):
+def create_location_if_not_exists(location, remote_folder_id=None):
+    remote_folder_id = remote_folder_id or session.cwd
+    created = False
     for location_part in list(filter(lambda x: x, location.split('/'))):
-        node = get_first_folder_by_name(location_part, remote_folder_id)
+        # a folder just created has no children to look up
+        node = not created and get_first_folder_by_name(
+            location_part, remote_folder_id)
         if node:
             remote_folder_id = node['id']
         else:
             remote_folder_id = create_folder(location_part, remote_folder_id)
+            created = True
     return remote_folder_id
 
 
 def set_cwd(location):
     """ Location can be ID or remote folder name"""
 
-    folder_node = get_node_by_location(location)
+    folder_node, breadcrumbs = resolve_location(location)
 
     if not folder_node:
         return
@@ -160,7 +369,7 @@ def set_cwd(location):
         print('Node type is not a folder')
         return
 
-    print(get_location(folder_node))
+    print(get_location(folder_node, breadcrumbs))
 
     session.cwd = folder_node['id']
     # logger.info('Current remote directory now is "%s" {%s}' % (
@@ -168,74 +377,90 @@ def set_cwd(location):
     return folder_node
 
 
-def print_cwd_nodes(show_id):
-    cwd_nodes = get_nodes()
+def print_cwd_nodes(show_id, cwd_nodes=None):
+    if cwd_nodes is None:
+        cwd_nodes = get_nodes()
     if show_id:
         for node in cwd_nodes:
             name = util.truncate_string_middle(node['name'], 30).ljust(30, ' ')
             print('%s {%s}' % (name, node['id']))
     else:
-        names = list(map(lambda x: x['name'], cwd_nodes))
+        names = map(lambda x: x['name'], cwd_nodes)
         num_in_group = 4
-        groups = [names[i:i+num_in_group]
-                  for i in range(0, len(names), num_in_group)]
-        for group in groups:
+        group = list(itertools.islice(names, num_in_group))
+        while group:
             for n in range(len(group), num_in_group):
                 group.append('')
             group = map(lambda x: util.truncate_string_middle(
                 x, 20).ljust(23, ' '), group)
             print('%s %s %s %s' % tuple(group))
+            group = list(itertools.islice(names, num_in_group))
 
 
-def get_location(node=None):
-    node = node or get_node_by_id(session.cwd)
-    breadcrumbs = get_node_breadcrumbs(node['id'])
+def get_location(node=None, breadcrumbs=None):
+    if not node or breadcrumbs is None:
+        node, breadcrumbs = fetch_node(node and node['id'] or session.cwd)
     names = list(map(lambda x: x['Name'] or '', breadcrumbs))
     if 'name' in node:
         names.insert(0, node['name'])
     return unquote('/'.join(names[::-1])) or '/'
 
 
-def get_node_by_location(location: str, prev_node=None):
+def get_node_by_location(location: str):
     """ Location can be ID or remote folder name"""
+    return resolve_location(location)[0]
 
-    if location == '/':
-        return get_node_by_id(session.owner)
 
-    if location.startswith('/'):
-        prev_node = get_node_by_id(session.owner)
-    else:
-        prev_node = prev_node or get_node_by_id(
-            session.cwd)
-
-    location_parts = list(filter(lambda x: x, location.split('/')))
-    if len(location_parts) > 1:
-        node = get_node_by_location(location_parts[0], prev_node)
-        if not node:
-            logger.error('Node not found "%s"' % location)
-            return
-        return get_node_by_location('/'.join(location_parts[1:]), node)
-    else:
-        location = location_parts[0]
-
-    if location == '..':
-        breadcrumbs = get_node_breadcrumbs(prev_node['id'])
-        node_id = breadcrumbs and breadcrumbs[0].get('Id') or session.owner
-        node = get_node_by_id(node_id)
-        print('node_id', node_id)
+def resolve_location(location: str, use_cache=True):
+    """Returns (node, breadcrumbs) tuple of the remote location.
+    Location can be ID, absolute or relative path with '..' parts.
+    Names are resolved with (parent id, name) -> id mappings remembered
+    from earlier lookups and breadcrumbs, listings are paged only until
+    the name is found. The node is fetched once, after the path
+    has been resolved"""
+    node_id = session.owner if location.startswith('/') else session.cwd
+    node, breadcrumbs = None, None
+    used_cache = False
 
+    for location_part in list(filter(lambda x: x, location.split('/'))):
+        if location_part == '.':
+            continue
+
+        if location_part == '..':
+            if node_id == session.owner:
+                continue
+            if breadcrumbs is None:
+                node, breadcrumbs = fetch_node(node_id)
+                if not node:
+                    return None, None
+            node_id = breadcrumbs and breadcrumbs[0].get('Id') or session.owner
+            node, breadcrumbs = None, breadcrumbs[1:] or None
+            continue
+
+        if util.is_valid_uuid4(location_part):
+            node, breadcrumbs = fetch_node(location_part)
+            if not node:
+                return None, None
+            node_id = node['id']
+            continue
+
+        child_id = use_cache and node_cache.get_child_id(
+            node_id, location_part)
+        if child_id:
+            used_cache = True
+            node, breadcrumbs, node_id = None, None, child_id
+            continue
+
+        node = get_first_node_by_name(location_part, node_id)
         if not node:
-            logger.error('Node not found "%s"')
-            return
-        return node
-
-    nodes = get_nodes_by_id_or_name(location, prev_node['id'])
-    nodes = list(filter(lambda x: x['name'] == location, nodes))
-
-    if not nodes:
-        logger.error('Couldn\'t find remote location "%s"' % location)
-        return
-
-    if len(nodes) > 1:
-        logger.warning('Found more than one node with name "%s"' % location)
-    return nodes[0]
+            logger.error('Couldn\'t find remote location "%s"' % location)
+            return None, None
+        node_cache.put_child_ids([(node_id, location_part, node['id'])])
+        breadcrumbs = None
+        node_id = node['id']
+
+    if not node or breadcrumbs is None:
+        node, breadcrumbs = fetch_node(node_id)
+    if not node and used_cache:
+        return resolve_location(location, False)
+    return node, breadcrumbs
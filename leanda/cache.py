@@ -0,0 +1,209 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from os import path
+
+from leanda.config import config
+
+
+class NodeCache():
+    """On-disk cache of remote nodes, their breadcrumbs, child listings
+    and (parent id, name) -> child id mappings used to resolve paths.
+
+    Entries younger than `ttl` seconds are served without a request.
+    Older nodes are revalidated with the ETag/Last-Modified validators
+    sent by the server. Least recently used entries are evicted once
+    the cache holds more than `size` entries.
+    """
+    path = '{}/.leanda/cache.db'.format(path.expanduser('~'))
+
+    def __init__(self, ttl=None, size=None):
+        if ttl is not None:
+            self.ttl = ttl
+        if size is not None:
+            self.size = size
+        self.connection = None
+        self.child_ids = {}
+        self.lock = threading.RLock()
+
+    def __getattr__(self, name):
+        # settings are read on first use, so importing the cache
+        # does not load the configuration
+        if name == 'ttl':
+            self.ttl = config.node_cache_ttl
+        elif name == 'size':
+            self.size = config.node_cache_size
+        elif name == 'enabled':
+            self.enabled = self.ttl > 0 and self.size > 0
+        else:
+            raise AttributeError(name)
+        return self.__dict__[name]
+
+    def connect(self):
+        if not self.connection:
+            os.makedirs(path.dirname(self.path), exist_ok=True)
+            connection = sqlite3.connect(
+                self.path, timeout=10, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.executescript('''
+                CREATE TABLE IF NOT EXISTS nodes (
+                    id TEXT PRIMARY KEY, node TEXT, breadcrumbs TEXT,
+                    etag TEXT, last_modified TEXT,
+                    fetched REAL, accessed REAL);
+                CREATE INDEX IF NOT EXISTS nodes_accessed
+                    ON nodes (accessed);
+                CREATE TABLE IF NOT EXISTS listings (
+                    id TEXT PRIMARY KEY, nodes TEXT,
+                    fetched REAL, accessed REAL);
+                CREATE INDEX IF NOT EXISTS listings_accessed
+                    ON listings (accessed);
+                CREATE TABLE IF NOT EXISTS names (
+                    parent_id TEXT, name TEXT, id TEXT, fetched REAL,
+                    accessed REAL, PRIMARY KEY (parent_id, name));
+                CREATE INDEX IF NOT EXISTS names_id ON names (id);
+                CREATE INDEX IF NOT EXISTS names_accessed
+                    ON names (accessed);
+            ''')
+            self.connection = connection
+        return self.connection
+
+    def execute(self, sql, params=()):
+        with self.lock:
+            connection = self.connect()
+            with connection:
+                return connection.execute(sql, params).fetchall()
+
+    def is_fresh(self, fetched):
+        return time.time() - fetched < self.ttl
+
+    def get_node(self, node_id):
+        """Returns cached entry as a dict with `node`, `breadcrumbs`,
+        `etag`, `last_modified` and `fresh` keys or None"""
+        if not self.enabled or not node_id:
+            return None
+        rows = self.execute(
+            'SELECT node, breadcrumbs, etag, last_modified, fetched '
+            'FROM nodes WHERE id = ?', (node_id,))
+        if not rows:
+            return None
+        (node, breadcrumbs, etag, last_modified, fetched) = rows[0]
+        self.execute('UPDATE nodes SET accessed = ? WHERE id = ?',
+                     (time.time(), node_id))
+        return {'node': json.loads(node),
+                'breadcrumbs': json.loads(breadcrumbs),
+                'etag': etag, 'last_modified': last_modified,
+                'fresh': self.is_fresh(fetched)}
+
+    def put_node(self, node_id, node, breadcrumbs,
+                 etag=None, last_modified=None):
+        if not self.enabled:
+            return
+        now = time.time()
+        self.execute(
+            'INSERT OR REPLACE INTO nodes VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (node_id, json.dumps(node), json.dumps(breadcrumbs),
+             etag, last_modified, now, now))
+        self.evict('nodes')
+
+    def touch_node(self, node_id):
+        """Marks cached node as fresh after successful revalidation"""
+        if not self.enabled:
+            return
+        self.execute('UPDATE nodes SET fetched = ? WHERE id = ?',
+                     (time.time(), node_id))
+
+    def get_listing(self, folder_id):
+        """Returns fresh cached child nodes of the folder or None"""
+        if not self.enabled or not folder_id:
+            return None
+        rows = self.execute(
+            'SELECT nodes, fetched FROM listings WHERE id = ?', (folder_id,))
+        if not rows or not self.is_fresh(rows[0][1]):
+            return None
+        self.execute('UPDATE listings SET accessed = ? WHERE id = ?',
+                     (time.time(), folder_id))
+        return json.loads(rows[0][0])
+
+    def put_listing(self, folder_id, nodes):
+        if not self.enabled:
+            return
+        now = time.time()
+        self.execute('INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?)',
+                     (folder_id, json.dumps(nodes), now, now))
+        self.evict('listings')
+
+    def get_child_id(self, parent_id, name):
+        """Returns id of the named child node if the mapping is fresh"""
+        if not self.enabled or not parent_id:
+            return None
+        key = (parent_id, name)
+        with self.lock:
+            if key not in self.child_ids:
+                rows = self.execute(
+                    'SELECT id, fetched FROM names '
+                    'WHERE parent_id = ? AND name = ?', key)
+                self.child_ids[key] = rows and rows[0] or (None, 0)
+            (node_id, fetched) = self.child_ids[key]
+        if not node_id or not self.is_fresh(fetched):
+            return None
+        return node_id
+
+    def put_child_ids(self, child_ids):
+        """Stores (parent id, name, child id) mappings"""
+        child_ids = [x for x in child_ids if x[0] and x[2]]
+        if not self.enabled or not child_ids:
+            return
+        now = time.time()
+        with self.lock:
+            for (parent_id, name, node_id) in child_ids:
+                self.child_ids[(parent_id, name)] = (node_id, now)
+            connection = self.connect()
+            with connection:
+                connection.executemany(
+                    'INSERT OR REPLACE INTO names VALUES (?, ?, ?, ?, ?)',
+                    [(*x, now, now) for x in child_ids])
+        self.evict('names', 'rowid')
+
+    def invalidate(self, *node_ids):
+        """Drops cached nodes, listings and name mappings of the given ids"""
+        node_ids = [x for x in node_ids if x]
+        if not self.enabled or not node_ids:
+            return
+        marks = ', '.join('?' * len(node_ids))
+        self.execute(f'DELETE FROM nodes WHERE id IN ({marks})', node_ids)
+        self.execute(f'DELETE FROM listings WHERE id IN ({marks})', node_ids)
+        self.execute(f'DELETE FROM names WHERE id IN ({marks}) '
+                     f'OR parent_id IN ({marks})', node_ids * 2)
+        with self.lock:
+            self.child_ids = {key: value for key, value
+                              in self.child_ids.items()
+                              if key[0] not in node_ids
+                              and value[0] not in node_ids}
+
+    def invalidate_listing(self, *folder_ids):
+        folder_ids = [x for x in folder_ids if x]
+        if not self.enabled or not folder_ids:
+            return
+        marks = ', '.join('?' * len(folder_ids))
+        self.execute(
+            f'DELETE FROM listings WHERE id IN ({marks})', folder_ids)
+
+    def evict(self, table, key='id'):
+        self.execute(
+            f'DELETE FROM {table} WHERE {key} IN (SELECT {key} FROM {table} '
+            'ORDER BY accessed DESC LIMIT -1 OFFSET ?)', (self.size,))
+
+    def clear(self):
+        with self.lock:
+            self.child_ids = {}
+        if path.exists(self.path):
+            self.execute('DELETE FROM nodes')
+            self.execute('DELETE FROM listings')
+            self.execute('DELETE FROM names')
+
+
+node_cache = NodeCache()
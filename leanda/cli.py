@@ -2,30 +2,67 @@ import click
 import json
 import logging
 import os
-import pkg_resources
 import sys
 
 from os import path
 
-from leanda import config, util
-from leanda.api import auth, nodes, blobs, category_trees
+from leanda import util
+from leanda.cache import node_cache
 from leanda.session import session
 
+# API modules are imported by the commands using them, so commands
+# like `whoami` or `pwd` do not load the HTTP, transfer and sync stacks
+
 logger = logging.getLogger('cli')
 
 
-@click.group(invoke_without_command=True, chain=True)
+class Group(click.Group):
+    """Reports authorization and request errors of the API without
+    a traceback"""
+
+    def invoke(self, ctx):
+        try:
+            return super().invoke(ctx)
+        except Exception as error:
+            http = sys.modules.get('leanda.api.http')
+            if not http or not isinstance(
+                    error, (http.AuthorizationError, http.RequestError)):
+                raise
+            logger.error(error)
+            ctx.exit(1)
+
+
+@click.group(cls=Group, invoke_without_command=True, chain=True)
 @click.option('--debug', is_flag=True, help='Enables debug mode.')
 @click.option('-v', '--version', is_flag=True, help='Show Leanda CLI version.')
-def cli(debug, version):
+@click.option('--no-cache', is_flag=True, help='Do not use local cache of remote nodes.')
+@click.option('--engine', type=click.Choice(['sync', 'async']), default='sync', help='Run ls, rm, upload and download on threads or on asyncio.')
+@click.pass_context
+def cli(ctx, debug, version, no_cache, engine):
     """A leanda command line interface."""
+    ctx.obj = engine
+    if no_cache:
+        node_cache.enabled = False
     if debug:
         logger.info(f'Debug mode is {"on" if debug else "off"}')
+        ctx.call_on_close(print_http_stats)
         # logging.getLogger().setLevel(logging.DEBUG)
     if version:
+        import pkg_resources
         logger.info(f'v{pkg_resources.require("Leanda")[0].version}')
 
 
+def print_http_stats():
+    from leanda.api import http
+
+    logger.info('HTTP requests: {requests}, connections: {opened} opened, '
+                '{reused} reused'.format(**http.transport.stats()))
+    if any(http.upload_timings.values()):
+        logger.info('Upload stages: ' + ', '.join(
+            f'{stage} {seconds:.2f}s'
+            for stage, seconds in http.upload_timings.items()))
+
+
 @cli.command()
 def whoami():
     """Check authorization and explore session data."""
@@ -37,6 +74,7 @@ def whoami():
 @click.option('-p', '--password', help='Password.', required=True, prompt=True, hide_input=True)
 def login(username, password):
     """Allows to login and store the login info for a Leanda user."""
+    from leanda.api import auth
     auth.login(username, password)
 
 
@@ -44,12 +82,14 @@ def login(username, password):
 def logout():
     """Do logout. Session data is removed."""
     session.save({})
+    node_cache.clear()
     logger.info('Session info was deleted.')
 
 
 @cli.command()
 def pwd():
     """Identify current Leanda working directory."""
+    from leanda.api import nodes
     print(nodes.get_location())
 
 
@@ -57,39 +97,65 @@ def pwd():
 @click.argument('remote_node_id')
 def cd(remote_node_id):
     """Change Leanda's current working directory."""
+    from leanda.api import nodes
     nodes.set_cwd(remote_node_id)
 
 
 @cli.command()
 @click.option('-s', '--show_id', help='Show id of nodes.', is_flag=True, default=False)
-def ls(show_id):
+@click.pass_obj
+def ls(engine, show_id):
     """Browse remote Leanda folder."""
+    if engine == 'async':
+        from leanda.api import aio
+        return aio.run(aio.print_cwd_nodes(show_id))
+    from leanda.api import nodes
     nodes.print_cwd_nodes(show_id)
 
 
 @cli.command()
 @click.argument('remote_nodes', nargs=-1)
-def rm(remote_nodes):
+@click.pass_obj
+def rm(engine, remote_nodes):
     """Allows to remove file or folder."""
-    for node_name_or_id in remote_nodes:
-        nodes.remove(node_name_or_id)
+    if engine == 'async':
+        from leanda.api import aio
+        return aio.run(aio.remove(list(remote_nodes)))
+    from leanda.api import nodes
+    nodes.remove(list(remote_nodes))
+
 
 @cli.command()
 @click.option('-r', '--remote', help='Remote folder id. Root if ommited.', default=None)
 @click.option('-l', '--local', help='Local directories and files (glob pattern) list. Current directory if ommited.', multiple=True, default=None)
-def upload(remote, local):
+@click.option('-j', '--jobs', help='Number of parallel uploads.', type=int, default=1)
+@click.option('--skip-existing', 'mode', flag_value='skip-existing', help='Skip files already present in the remote folder.')
+@click.option('--update', 'mode', flag_value='update', help='Skip files with the same size and modification time in the remote folder.')
+@click.option('--checksum', help='With --update also compare MD5 checksums.', is_flag=True, default=False)
+@click.pass_obj
+def upload(engine, remote, local, jobs, mode, checksum):
     """Upload local direcory or file list to remote folder."""
-    blobs.upload(local, remote)
+    if engine == 'async':
+        from leanda.api import aio
+        return aio.run(aio.upload(local, remote, jobs, mode, checksum))
+    from leanda.api import blobs
+    blobs.upload(local, remote, jobs, mode, checksum)
 
 
 @cli.command()
 @click.option('-r', '--remote', help='Remote folder id. Root if ommited.', default=None)
 @click.option('-l', '--local', help='Local directory. Current directory if ommited.', default=None)
-def download(remote, local):
+@click.option('-j', '--jobs', help='Number of parallel downloads.', type=int, default=1)
+@click.pass_obj
+def download(engine, remote, local, jobs):
     """Download remote folder or file list to local directory."""
+    if engine == 'async':
+        from leanda.api import aio
+        return aio.run(aio.download(remote, local, jobs))
+    from leanda.api import blobs, nodes
     remote = nodes.get_node_by_id(remote or session.cwd)
     local = local or os.getcwd()
-    blobs.download_folder(remote, local)
+    blobs.download_folder(remote, local, jobs)
 
 
 @cli.command()
@@ -98,11 +164,13 @@ def download(remote, local):
 @click.option('-l', '--local', help='Local directory path. Current directory if ommited.', default=None)
 def livesync(watch, remote, local):
     """Sync local direcory with remote folder."""
-    remote = nodes.get_node_by_id(
-        remote or session.cwd) or nodes.get_node_by_id(session.owner)
+    from leanda.api import blobs, nodes
+    (remote, breadcrumbs) = nodes.fetch_node(remote or session.cwd)
+    if not remote:
+        (remote, breadcrumbs) = nodes.fetch_node(session.owner)
     local = path.abspath(local or os.getcwd())
     print('Local folder is "%s"' % local)
-    print('Remote folder is "%s"' % nodes.get_location(remote))
+    print('Remote folder is "%s"' % nodes.get_location(remote, breadcrumbs))
     blobs.sync(local, remote)
 
 
@@ -111,4 +179,16 @@ def livesync(watch, remote, local):
 @cli.command()
 def categories():
     """List categories"""
+    from leanda.api import category_trees
     logger.info(util.pretty_json(category_trees.get_categories()))
+
+
+@cli.command()
+@click.option('--stop', help='Stop the running daemon.', is_flag=True, default=False)
+def daemon(stop):
+    """Serve commands from a process keeping connections and cache warm."""
+    from leanda.daemon import serve, stop as stop_daemon
+    if stop:
+        stop_daemon()
+    else:
+        serve()
@@ -1,10 +1,8 @@
-import humanfriendly
 import json
 import logging
 import os
 import sys
 
-from dotenv import load_dotenv
 from os import path
 from pathlib import Path
 
@@ -13,22 +11,67 @@ from leanda import logger
 logger.initialize()
 logger = logging.getLogger('config')
 
-env_path = Path('.') / 'environments/dev.env'
-load_dotenv(dotenv_path=env_path)
-
 
 class Config:
-    web_core_api_url = os.getenv("LEANDA_WEB_CORE_API_URL")
-    web_blob_api_url = os.getenv("LEANDA_WEB_BLOB_API_URL")
-    web_socket_url = os.getenv("LEANDA_WEB_SOCKET_URL")
-    identity_server_url = os.getenv("LEANDA_IDENTITY_SERVER_URL")
-    file_upload_limit = os.getenv("LEANDA_FILE_UPLOAD_LIMIT")
-    file_upload_limit_int = humanfriendly.parse_size(
-        os.getenv("LEANDA_FILE_UPLOAD_LIMIT") or '50MB', binary=True)
-    file_download_limit = os.getenv("LEANDA_FILE_DOWNLOAD_LIMIT")
-    file_download_limit_int = humanfriendly.parse_size(
-        os.getenv("LEANDA_FILE_DOWNLOAD_LIMIT") or '50MB', binary=True)
+    """Settings of LEANDA_* environment variables, defaults are read from
+    environments/dev.env. Loaded on first access, so commands not
+    using them do not import dotenv and humanfriendly"""
+
+    def __getattr__(self, name):
+        if name.startswith('_') or self.__dict__.get('loaded'):
+            raise AttributeError(name)
+        self.load()
+        return getattr(self, name)
+
+    def load(self):
+        import humanfriendly
+        from dotenv import load_dotenv
+
+        load_dotenv(dotenv_path=Path('.') / 'environments/dev.env')
+
+        def parse_size(name, default):
+            return humanfriendly.parse_size(
+                os.getenv(name) or default, binary=True)
+
+        settings = {
+            'web_core_api_url': os.getenv("LEANDA_WEB_CORE_API_URL"),
+            'web_blob_api_url': os.getenv("LEANDA_WEB_BLOB_API_URL"),
+            'web_socket_url': os.getenv("LEANDA_WEB_SOCKET_URL"),
+            'identity_server_url': os.getenv("LEANDA_IDENTITY_SERVER_URL"),
+            'file_upload_limit': os.getenv("LEANDA_FILE_UPLOAD_LIMIT"),
+            'file_upload_limit_int': parse_size(
+                "LEANDA_FILE_UPLOAD_LIMIT", '50MB'),
+            'file_download_limit': os.getenv("LEANDA_FILE_DOWNLOAD_LIMIT"),
+            'file_download_limit_int': parse_size(
+                "LEANDA_FILE_DOWNLOAD_LIMIT", '50MB'),
+            'file_limit_policy': (os.getenv("LEANDA_FILE_LIMIT_POLICY") or
+                                  'stream').lower(),
+            'upload_part_size': parse_size("LEANDA_UPLOAD_PART_SIZE", '8MB'),
+            'download_chunk_size': parse_size(
+                "LEANDA_DOWNLOAD_CHUNK_SIZE", '1MB'),
+            'download_segments': int(
+                os.getenv("LEANDA_DOWNLOAD_SEGMENTS") or 1),
+            'segmented_download_size': parse_size(
+                "LEANDA_SEGMENTED_DOWNLOAD_SIZE", '64MB'),
+            'http_pool_size': int(os.getenv("LEANDA_HTTP_POOL_SIZE") or 10),
+            'http_retries': int(os.getenv("LEANDA_HTTP_RETRIES") or 3),
+            'http_backoff_factor': float(
+                os.getenv("LEANDA_HTTP_BACKOFF_FACTOR") or 0.5),
+            'page_size': int(os.getenv("LEANDA_PAGE_SIZE") or 100),
+            'page_prefetch': int(os.getenv("LEANDA_PAGE_PREFETCH") or 4),
+            'remove_batch_size': int(
+                os.getenv("LEANDA_REMOVE_BATCH_SIZE") or 100),
+            'node_cache_ttl': float(os.getenv("LEANDA_CACHE_TTL") or 60),
+            'node_cache_size': int(os.getenv("LEANDA_CACHE_SIZE") or 10000),
+            'sync_debounce': float(os.getenv("LEANDA_SYNC_DEBOUNCE") or 1),
+            'async_concurrency': int(
+                os.getenv("LEANDA_ASYNC_CONCURRENCY") or 100),
+        }
+        # values assigned before loading are kept
+        for (name, value) in settings.items():
+            self.__dict__.setdefault(name, value)
+        self.loaded = True
+        logger.debug(settings)
 
 
 config = Config()
-logger.debug(config)
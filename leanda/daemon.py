@@ -0,0 +1,331 @@
+import _thread
+import io
+import json
+import logging
+import os
+import queue
+import socket
+import sys
+import threading
+import traceback
+
+from contextlib import contextmanager, redirect_stderr, redirect_stdout
+from os import path
+
+from leanda import logger
+
+# Kept free of other leanda imports: `main` decides whether to forward
+# the command before the configuration and API modules are loaded
+
+logger.initialize()
+logger = logging.getLogger('daemon')
+
+SOCKET_PATH = '{}/.leanda/daemon.sock'.format(path.expanduser('~'))
+ENV_FILE = 'environments/dev.env'
+# interactive and long running commands always run in-process
+LOCAL_COMMANDS = {'login', 'livesync', 'daemon'}
+
+
+def main():
+    """Entry point of the `leanda` command.
+    Forwards the command to a running daemon, runs it in-process otherwise"""
+    code = forward(sys.argv[1:])
+    if code is None:
+        from leanda.cli import cli
+        cli(prog_name='leanda')
+    sys.exit(code)
+
+
+def forward(argv, socket_path=SOCKET_PATH):
+    """Runs the command in the daemon and returns its exit code.
+    Returns None when the command has to run in-process"""
+    if os.getenv('LEANDA_NO_DAEMON') or LOCAL_COMMANDS & set(argv):
+        return None
+    connection = connect(socket_path)
+    if not connection:
+        return None
+    with connection:
+        send(connection, {'argv': argv, 'cwd': os.getcwd(),
+                          'environment': get_environment(),
+                          'tty': [sys.stdout.isatty(), sys.stderr.isatty()]})
+        try:
+            for line in connection.makefile('r', encoding='utf-8'):
+                message = json.loads(line)
+                if 'refused' in message:
+                    logger.debug(f'Running in-process: {message["refused"]}')
+                    return None
+                if 'exit' in message:
+                    return message['exit']
+                stream = sys.stdout if 'stdout' in message else sys.stderr
+                stream.write(message.get('stdout', message.get('stderr')))
+                stream.flush()
+        except KeyboardInterrupt:
+            print('Aborted!', file=sys.stderr)
+    return 1
+
+
+def connect(socket_path=SOCKET_PATH):
+    """Returns connection to the running daemon or None"""
+    if not hasattr(socket, 'AF_UNIX') or not path.exists(socket_path):
+        return None
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_path)
+    except OSError:
+        connection.close()
+        return None
+    return connection
+
+
+def send(connection, message):
+    connection.sendall((json.dumps(message) + '\n').encode())
+
+
+def get_environment():
+    """Returns everything the configuration is read from: LEANDA_*
+    environment variables and the .env file of the working directory"""
+    variables = {key: value for (key, value) in os.environ.items()
+                 if key.startswith('LEANDA_') and key != 'LEANDA_NO_DAEMON'}
+    env_file = path.isfile(ENV_FILE) and \
+        [path.realpath(ENV_FILE), path.getmtime(ENV_FILE)] or None
+    return {'variables': variables, 'env_file': env_file}
+
+
+def stop(socket_path=SOCKET_PATH):
+    """Stops the running daemon once it finishes the current command"""
+    connection = connect(socket_path)
+    if not connection:
+        logger.error('Daemon is not running')
+        return
+    with connection:
+        send(connection, {'stop': True})
+        connection.makefile('r', encoding='utf-8').readline()
+    logger.info('Daemon is stopped')
+
+
+def serve(socket_path=SOCKET_PATH):
+    """Serves commands sent by `forward` until stopped.
+
+    Commands run one at a time in the daemon process, so the HTTP
+    connection pool, node cache and session stay warm between them.
+    Each command runs in the client's working directory with its
+    output streamed back to the client. Commands arriving while
+    another one runs and commands of clients with another environment
+    than the daemon's are refused, the client runs them in-process.
+    """
+    # taken before the configuration loads the .env file into os.environ
+    environment = get_environment()
+    from leanda.api import auth, blobs, http, nodes  # noqa: F401 loads API stack
+    from leanda.cli import cli
+
+    probe = connect(socket_path)
+    if probe:
+        probe.close()
+        logger.error(f'Daemon is already running on {socket_path}')
+        return
+    if path.exists(socket_path):
+        os.remove(socket_path)
+    os.makedirs(path.dirname(socket_path), exist_ok=True)
+    http.transport.connect()
+    auth.keep_fresh()
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        server.bind(socket_path)
+        os.chmod(socket_path, 0o600)
+        server.listen()
+        logger.info(f'Daemon is serving on {socket_path}')
+        requests = queue.Queue()
+        busy = threading.Event()
+        threading.Thread(target=accept, daemon=True,
+                         args=(server, requests, busy, environment)).start()
+        running = True
+        while running:
+            (connection, request) = requests.get()
+            with connection:
+                running = handle(connection, request, cli)
+            busy.clear()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        if path.exists(socket_path):
+            os.remove(socket_path)
+    logger.info('Daemon is stopped')
+
+
+def accept(server, requests, busy, environment):
+    """Reads requests of new connections and passes them to the serving
+    thread. Refuses commands while `busy` and commands of clients with
+    another environment. A stop request waits for the current command,
+    commands arriving after it are refused"""
+    stopping = False
+    while True:
+        try:
+            (connection, _) = server.accept()
+        except OSError:
+            # the server socket is closed
+            return
+        try:
+            connection.settimeout(5)
+            line = connection.makefile('r', encoding='utf-8').readline()
+            connection.settimeout(None)
+            request = json.loads(line) if line else None
+        except (OSError, ValueError) as error:
+            logger.debug(error, exc_info=True)
+            request = None
+        if request is None:
+            connection.close()
+        elif stopping:
+            refuse(connection, 'stopping')
+        elif request.get('stop'):
+            stopping = True
+            requests.put((connection, request))
+        elif request.get('environment') != environment:
+            refuse(connection, 'environment differs from the daemon')
+        elif busy.is_set():
+            refuse(connection, 'busy')
+        else:
+            busy.set()
+            requests.put((connection, request))
+
+
+def refuse(connection, reason):
+    with connection:
+        try:
+            send(connection, {'refused': reason})
+        except OSError:
+            pass
+
+
+def handle(connection, request, cli):
+    """Runs one command request. Returns False on a stop request"""
+    if request.get('stop'):
+        send(connection, {'exit': 0})
+        return False
+    client = Client(connection, *request.get('tty', [False, False]))
+    try:
+        client.send({'exit': client.run(cli, request['argv'], request['cwd'])})
+    except KeyboardInterrupt:
+        # interrupted by a client that went away right after the command
+        pass
+    return True
+
+
+class Client():
+    """Connection of a forwarded command and its output streams.
+
+    A client going away while its command runs interrupts the command
+    the way Ctrl-C interrupts it in-process. Output written after that
+    is dropped.
+    """
+
+    def __init__(self, connection, stdout_tty=False, stderr_tty=False):
+        self.connection = connection
+        self.lock = threading.Lock()
+        self.running = False
+        self.gone = False
+        self.stdout = ClientStream(self, 'stdout', stdout_tty)
+        self.stderr = ClientStream(self, 'stderr', stderr_tty)
+
+    def send(self, message):
+        with self.lock:
+            if self.gone:
+                return
+            try:
+                send(self.connection, message)
+            except OSError:
+                self.gone = True
+
+    def watch(self):
+        """Waits for the client to close the connection"""
+        try:
+            while self.connection.recv(1024):
+                pass
+        except OSError:
+            pass
+        with self.lock:
+            self.gone = True
+            if self.running:
+                _thread.interrupt_main()
+
+    def run(self, cli, argv, cwd):
+        from leanda.api import http
+        from leanda.cache import node_cache
+
+        daemon_cwd = os.getcwd()
+        cache_enabled = node_cache.enabled
+        code = 0
+        try:
+            with redirect_logging(self.stderr), \
+                    redirect_stdout(self.stdout), \
+                    redirect_stderr(self.stderr):
+                try:
+                    with self.lock:
+                        self.running = True
+                    threading.Thread(target=self.watch, daemon=True).start()
+                    os.chdir(cwd)
+                    http.reset_stats()
+                    cli.main(args=argv, prog_name='leanda')
+                except SystemExit as e:
+                    code = e.code
+                except Exception:
+                    traceback.print_exc()
+                    code = 1
+                finally:
+                    with self.lock:
+                        self.running = False
+                if isinstance(code, str):
+                    print(code, file=sys.stderr)
+                    code = 1
+        except KeyboardInterrupt:
+            code = 1
+        finally:
+            os.chdir(daemon_cwd)
+            node_cache.enabled = cache_enabled
+        return code or 0
+
+
+class ClientStream(io.TextIOBase):
+    """Text stream sending everything written to the client"""
+    encoding = 'utf-8'
+
+    def __init__(self, client, name, tty):
+        self.client = client
+        self.name = name
+        self.tty = tty
+
+    def write(self, text):
+        if text:
+            self.client.send({self.name: text})
+        return len(text)
+
+    def isatty(self):
+        return self.tty
+
+    def writable(self):
+        return True
+
+
+def get_console_handlers():
+    loggers = [logging.getLogger(), *[
+        x for x in logging.Logger.manager.loggerDict.values()
+        if isinstance(x, logging.Logger)]]
+    return [handler for x in loggers for handler in x.handlers
+            if isinstance(handler, logging.StreamHandler)
+            and not isinstance(handler, logging.FileHandler)]
+
+
+@contextmanager
+def redirect_logging(stream):
+    """Points console log handlers, including handlers of loggers
+    created meanwhile, to the stream"""
+    daemon_stream = sys.stderr
+    originals = {handler: handler.stream for handler in get_console_handlers()}
+    for handler in originals:
+        handler.setStream(stream)
+    try:
+        yield
+    finally:
+        for handler in get_console_handlers():
+            handler.setStream(originals.get(handler, daemon_stream))
@@ -1,10 +1,19 @@
-from os import path
 import json
+import os
+import tempfile
+import threading
+
+from os import path
 
 # from leanda.api import nodes
 
 
 class Session():
+    """Session data kept in memory and persisted to ~/.leanda.json.
+
+    The file is re-read only when it was changed by another process
+    and written only when the session data actually changes.
+    """
     path = '{}/.leanda.json'.format(path.expanduser('~'))
 
     token: str
@@ -12,34 +21,71 @@ class Session():
     cwd: str
     user: {}
 
-    def __getattribute__(self, name):
-        if name in dir(Session):
-            return super().__getattribute__(name)
-        return self.load().get(name, None)
+    def __init__(self):
+        object.__setattr__(self, '_data', None)
+        object.__setattr__(self, '_stamp', None)
+        object.__setattr__(self, '_lock', threading.RLock())
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self._load().get(name, None)
 
     def __setattr__(self, name, value):
         self.update({name: value})
-        return super().__setattr__(name, value)
 
     def save(self, session):
-        with open(self.path, 'w') as f:
-            json.dump(session, f, indent=4)
+        with self._lock:
+            object.__setattr__(self, '_data', dict(session))
+            self._write(self._data)
 
     def update(self, session_params):
-        if path.exists(self.path):
-            session = self.load()
-        else:
-            session = {}
-        session.update(session_params)
-        self.save(session)
+        with self._lock:
+            session = self._load()
+            if all(key in session and session[key] == value
+                   for key, value in session_params.items()):
+                return
+            session = dict(session)
+            session.update(session_params)
+            self.save(session)
 
     def load(self):
-        if path.exists(self.path):
-            with open(self.path, 'r') as f:
-                return json.load(f)
-        else:
-            print('The last session not found')
-            return {'token': '', 'cwd': '', 'owner': '', }
+        return dict(self._load())
+
+    def _load(self):
+        with self._lock:
+            stamp = self._get_stamp()
+            if self._data is not None and stamp == self._stamp:
+                return self._data
+            if stamp:
+                with open(self.path, 'r') as f:
+                    data = json.load(f)
+            else:
+                print('The last session not found')
+                data = {'token': '', 'cwd': '', 'owner': '', }
+            object.__setattr__(self, '_data', data)
+            object.__setattr__(self, '_stamp', stamp)
+            return data
+
+    def _get_stamp(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def _write(self, session):
+        fd, tmp_path = tempfile.mkstemp(
+            dir=path.dirname(self.path), prefix='.leanda.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(session, f, indent=4)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            if path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        object.__setattr__(self, '_stamp', self._get_stamp())
 
 
 session = Session()
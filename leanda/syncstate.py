@@ -0,0 +1,166 @@
+import hashlib
+import os
+import sqlite3
+import threading
+
+from datetime import datetime
+from os import path, walk
+
+LEGACY_SYNC_FILE = '.leanda-sync'
+
+
+def read_legacy_sync_file(leanda_sync_path):
+    """Returns entries of a `.leanda-sync` file written by older versions
+    as a dict of name -> {'mtime': ns, 'size': bytes, 'hash': sha256}"""
+    delimeter = ': '
+    timestamp_fmt = '%Y-%m-%d %H:%M:%S %f'
+    sync_dict = {}
+    with open(leanda_sync_path, 'r') as f:
+        for line in [line.rstrip('\n') for line in f]:
+            if not line:
+                continue
+            if '\t' in line:
+                (mtime, size, file_hash, name) = line.split('\t', 3)
+                sync_dict[name] = {'mtime': int(mtime),
+                                   'size': size and int(size) or None,
+                                   'hash': file_hash or None}
+            else:
+                modified_datetime = datetime.strptime(
+                    line.split(delimeter)[0], timestamp_fmt)
+                sync_dict[line.split(delimeter, 1)[1]] = {
+                    'mtime': int(modified_datetime.timestamp() * 1e6) * 1000,
+                    'size': None, 'hash': None}
+    return sync_dict
+
+
+class SyncState():
+    """Sync state of a local directory tree kept in one SQLite database
+    under ~/.leanda/sync, outside of the synced tree.
+
+    Maps path relative to the sync root to remote node id, size,
+    modification time (ns) and sha256 of synced files and folders.
+    Every change is committed on its own, so an interrupted sync keeps
+    the state of files synced so far. `.leanda-sync` files left by older
+    versions are imported and removed when the database is created.
+    """
+    folder = '{}/.leanda/sync'.format(path.expanduser('~'))
+
+    def __init__(self, root):
+        self.root = path.realpath(root)
+        root_hash = hashlib.sha256(self.root.encode()).hexdigest()[:16]
+        self.path = f'{self.folder}/{root_hash}.db'
+        self.lock = threading.RLock()
+        os.makedirs(self.folder, exist_ok=True)
+        self.connection = sqlite3.connect(
+            self.path, timeout=10, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS entries (
+                path TEXT PRIMARY KEY, parent TEXT, name TEXT,
+                node_id TEXT, size INTEGER, mtime INTEGER, hash TEXT,
+                is_dir INTEGER);
+            CREATE INDEX IF NOT EXISTS entries_parent ON entries (parent);
+            CREATE INDEX IF NOT EXISTS entries_node_id ON entries (node_id);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        ''')
+        if not self.execute("SELECT value FROM meta WHERE key = 'root'"):
+            self.migrate()
+            self.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                         ('root', self.root))
+
+    def execute(self, sql, params=()):
+        with self.lock:
+            with self.connection:
+                return self.connection.execute(sql, params).fetchall()
+
+    def relpath(self, local_path):
+        relpath = path.relpath(path.realpath(local_path), self.root)
+        return '' if relpath == '.' else relpath.replace(os.sep, '/')
+
+    def get(self, local_path):
+        """Returns entry of the path or None"""
+        rows = self.execute(
+            'SELECT node_id, size, mtime, hash, is_dir '
+            'FROM entries WHERE path = ?', (self.relpath(local_path),))
+        if not rows:
+            return None
+        (node_id, size, mtime, file_hash, is_dir) = rows[0]
+        return {'node_id': node_id, 'size': size, 'mtime': mtime,
+                'hash': file_hash, 'is_dir': bool(is_dir)}
+
+    def find(self, node_id):
+        """Returns local path of the synced remote node or None"""
+        rows = self.execute(
+            'SELECT path FROM entries WHERE node_id = ?', (node_id,))
+        return rows and path.join(self.root, rows[0][0]) or None
+
+    def children(self, local_directory):
+        """Returns entries of the directory as a dict of name -> entry"""
+        rows = self.execute(
+            'SELECT name, node_id, size, mtime, hash, is_dir '
+            'FROM entries WHERE parent = ?', (self.relpath(local_directory),))
+        return {name: {'node_id': node_id, 'size': size, 'mtime': mtime,
+                       'hash': file_hash, 'is_dir': bool(is_dir)}
+                for (name, node_id, size, mtime, file_hash, is_dir) in rows}
+
+    def put(self, local_path, mtime, size=None, file_hash=None,
+            node_id=None, is_dir=False):
+        relpath = self.relpath(local_path)
+        (parent, _, name) = relpath.rpartition('/')
+        self.execute(
+            'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (relpath, parent, name, node_id, size, mtime, file_hash,
+             int(is_dir)))
+
+    def delete(self, local_path):
+        """Removes entry of the path and of everything below it"""
+        relpath = self.relpath(local_path)
+        prefix = relpath + '/'
+        self.execute(
+            'DELETE FROM entries WHERE path = ? OR substr(path, 1, ?) = ?',
+            (relpath, len(prefix), prefix))
+
+    def move(self, old_path, new_path):
+        """Moves entry of the path and of everything below it"""
+        old = self.relpath(old_path)
+        new = self.relpath(new_path)
+        (parent, _, name) = new.rpartition('/')
+        prefix = old + '/'
+        with self.lock:
+            with self.connection:
+                self.connection.execute(
+                    'UPDATE entries SET path = ?, parent = ?, name = ? '
+                    'WHERE path = ?', (new, parent, name, old))
+                self.connection.execute(
+                    'UPDATE entries SET path = ? || substr(path, ?), '
+                    'parent = ? || substr(parent, ?) '
+                    'WHERE substr(path, 1, ?) = ?',
+                    (new, len(old) + 1, new, len(old) + 1, len(prefix),
+                     prefix))
+
+    def migrate(self):
+        """Imports and removes `.leanda-sync` files of the tree"""
+        legacy_files = []
+        rows = []
+        for (dirpath, dirnames, filenames) in walk(self.root):
+            if LEGACY_SYNC_FILE not in filenames:
+                continue
+            leanda_sync_path = path.join(dirpath, LEGACY_SYNC_FILE)
+            parent = self.relpath(dirpath)
+            for name, entry in read_legacy_sync_file(leanda_sync_path).items():
+                rows.append((parent and f'{parent}/{name}' or name, parent,
+                             name, None, entry['size'], entry['mtime'],
+                             entry['hash'], int(name in dirnames)))
+            legacy_files.append(leanda_sync_path)
+        with self.lock:
+            with self.connection:
+                self.connection.executemany(
+                    'INSERT OR REPLACE INTO entries '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        for leanda_sync_path in legacy_files:
+            os.remove(leanda_sync_path)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
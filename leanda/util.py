@@ -1,4 +1,5 @@
 import click
+import hashlib
 import uuid
 
 from os import path
@@ -55,3 +56,12 @@ def pretty_json(obj):
     if isinstance(obj, str):
         obj = json.loads(obj)
     return json.dumps(obj, indent=4, sort_keys=True)
+
+
+def get_file_hash(file_path, algorithm='sha256', chunk_size=1024 * 1024):
+    """Returns hex digest of the file read in chunks"""
+    file_hash = hashlib.new(algorithm)
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
@@ -25,6 +25,6 @@ setuptools.setup(
     ],
     entry_points='''
         [console_scripts]
-        leanda=leanda.cli:cli
+        leanda=leanda.daemon:main
     ''',
 )